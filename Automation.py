@@ -1,31 +1,60 @@
 # © 2024 Keita Iwasa
 
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.support.ui import WebDriverWait, Select
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import TimeoutException
-
 import time
 import os
 import sys
 import logging
-from openpyxl import load_workbook
-import pandas as pd
-import winreg
 import configparser
 import json
 import requests
+from requests.adapters import HTTPAdapter
 from datetime import datetime, timedelta
 import random
+import hashlib
 import glob
+from urllib.parse import urljoin
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+try:
+    from watchdog.observers import Observer
+except ImportError: # watchdogがない場合はポーリングでダウンロードを監視する
+    Observer = None
+
+from tracing import RunTimeline, traced
+from platform_paths import downloads_folder
+
+# Selenium・pandasは読み込みに時間がかかるので、アプリの起動時には読み込まない
+# Seleniumはload_selenium（ブラウザの起動時・warm_up）、pandasはorder_dataを使うメソッドの中で読み込む
+webdriver = Options = WebDriverWait = Select = By = EC = TimeoutException = None
+
+def load_selenium():
+    global webdriver, Options, WebDriverWait, Select, By, EC, TimeoutException
+    if webdriver is not None:
+        return
+    from selenium.webdriver.chrome.options import Options
+    from selenium.webdriver.support.ui import WebDriverWait, Select
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.common.exceptions import TimeoutException
+    from selenium import webdriver # 読み込み済みの判定に使うので最後に設定する
+
+def warm_up():
+    # 画面の表示後にバックグラウンドのスレッドで呼び、最初のダウンロード・入力の待ち時間を減らす
+    load_selenium()
+    import order_data
+
+# 設定ファイルの読み込み（最初に使うときに読み込む）
+_settings = None
 
-# 設定ファイルの読み込み
-config = configparser.ConfigParser()
-with open('setup/config.ini', 'r', encoding='utf-8') as file:
-    config.read_file(file)
-st = config['Settings'] 
+def default_settings():
+    global _settings
+    if _settings is None:
+        config = configparser.ConfigParser()
+        with open('setup/config.ini', 'r', encoding='utf-8') as file:
+            config.read_file(file)
+        _settings = config['Settings']
+    return _settings
 
 def resource_path(relative_path):
     try:
@@ -34,106 +63,609 @@ def resource_path(relative_path):
         base_path = os.path.abspath(".")
     return os.path.join(base_path, relative_path)
 
+# 発注数を一括入力するJavaScript
+# arguments[0]: [[prdxのid, 発注入力数], ...]
+# 戻り値: 行ごとの結果 {id, status, value, max}（status: ok / max(制限数量超え) / notfound / error）
+BULK_INPUT_SCRIPT = """
+const orders = arguments[0];
+const results = [];
+const dialogText = () => {
+    const dialog = document.getElementById('divDialog');
+    if (!dialog || dialog.offsetParent === null) { return ''; }
+    return dialog.innerText || '';
+};
+const closeDialog = () => {
+    const closeButton = document.querySelector('.ui-icon-closethick');
+    if (closeButton) { closeButton.click(); }
+};
+const setValue = (input, value) => {
+    input.focus();
+    input.value = String(value);
+    ['input', 'keyup', 'change', 'blur'].forEach((type) => {
+        input.dispatchEvent(new Event(type, {bubbles: true}));
+    });
+};
+for (const [id, value] of orders) {
+    const input = document.getElementById(id);
+    if (!input) {
+        results.push({id: id, status: 'notfound', value: 0});
+        continue;
+    }
+    setValue(input, value);
+    const text = dialogText();
+    if (text === '') {
+        results.push({id: id, status: 'ok', value: value});
+        continue;
+    }
+    closeDialog();
+    if (text.includes('制限数量')) {
+        // 制限数量を超えない最大のセット数の倍数を入力
+        const setSize = parseInt(input.getAttribute('data-sthtsu'), 10) || 1;
+        const limit = parseInt(input.getAttribute('data-sgosuu'), 10);
+        if (!Number.isFinite(limit) || limit <= 0) {
+            // 制限数量が取得できない場合は入力しない（1行ずつの入力と同じ）
+            results.push({id: id, status: 'error', value: value, message: text});
+            continue;
+        }
+        const maxOrder = limit - 1;
+        const maxInput = Math.floor(maxOrder / setSize) * setSize;
+        setValue(input, maxInput);
+        closeDialog();
+        results.push({id: id, status: 'max', value: maxInput, max: maxOrder});
+    } else {
+        results.push({id: id, status: 'error', value: value, message: text});
+    }
+}
+return results;
+"""
+
+# 発注入力画面の商品一覧を取得するJavaScript
+# scode・syhnnm・prdxは画面上で同じ順番に並んでいるので、インデックスで対応づける
+# 戻り値: [{code, name, prdx, set, limit}, ...]（set: data-sthtsu, limit: data-sgosuu）
+ORDER_TABLE_SCRIPT = """
+const codes = document.getElementsByClassName('scode');
+const names = document.querySelectorAll("span[id^='syhnnm']");
+const inputs = document.querySelectorAll("input[id^='prdx']");
+const rows = [];
+for (let i = 0; i < Math.min(codes.length, inputs.length); i++) {
+    rows.push({
+        code: parseInt(codes[i].textContent.trim(), 10),
+        name: names[i] ? names[i].textContent.trim() : '',
+        prdx: inputs[i].id,
+        set: parseInt(inputs[i].getAttribute('data-sthtsu'), 10),
+        limit: parseInt(inputs[i].getAttribute('data-sgosuu'), 10)
+    });
+}
+return rows;
+"""
+
+# プロセス全体で共有するHTTPセッション
+# GASやサポートサーバーへの接続をプールしてKeep-Aliveで再利用し、呼び出しごとのTLSハンドシェイクを省く
+_http_session = None
+_http_session_lock = threading.Lock()
+# GAS呼び出しの所要時間の記録（新しいものから最大200件）
+gas_call_log = deque(maxlen=200)
+
+def http_session():
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            session = requests.Session()
+            # 再試行はRetryPolicy（GasRetry）だけで行う（アダプターでも再試行すると回数と待ち時間が重なり、httpxの非同期版とも異なる）
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=0)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _http_session = session
+        return _http_session
+
+def gas_latency_summary():
+    # GAS関数ごとの呼び出し回数・平均・最大の所要時間（秒）
+    summary = {}
+    for record in gas_call_log:
+        summary.setdefault(record['function'], []).append(record['seconds'])
+    return {function: {'count': len(seconds), 'avg': round(sum(seconds) / len(seconds), 2), 'max': round(max(seconds), 2)} for function, seconds in summary.items()}
+
+# 通信結果のキャッシュの有効期限（秒）
+CACHE_TTL = {'version': 3600, 'notices': 3600, 'original_sheet': 86400,
+             'existing_sheet': 60, # 起動時に確認した作成済みの発注書（別の端末で作成される場合があるので短くする）
+             'gas_batch': 86400} # GASがbatch関数に対応しているか（GASを更新した場合は翌日から使う）
+
+class LocalCache:
+    # 通信結果のキャッシュ（JSONファイル）
+    # キーごとに値・保存時刻・ETag/Last-Modifiedを保存し、有効期限内であれば通信せずに使う
+    # 期限切れでも削除せず、通信に失敗したときの代わりの値として使う
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = None # 最初に使うときに読み込む
+
+    def load(self):
+        if self.entries is None:
+            try:
+                with open(self.path, 'r', encoding='utf-8') as file:
+                    self.entries = json.load(file)
+            except (FileNotFoundError, ValueError):
+                self.entries = {}
+        return self.entries
+
+    def save(self):
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump(self.entries, file, ensure_ascii=False)
+        os.replace(temp_path, self.path)
+
+    def last(self, key): # 最後に保存した値（期限切れを含む）
+        with self.lock:
+            return self.load().get(key)
+
+    def fresh(self, key, ttl): # 有効期限内の値
+        entry = self.last(key)
+        if entry and time.time() - entry['stored_at'] < ttl:
+            return entry
+        return None
+
+    def set(self, key, value, etag=None, last_modified=None):
+        with self.lock:
+            self.load()[key] = {'value': value, 'stored_at': time.time(), 'etag': etag, 'last_modified': last_modified}
+            try:
+                self.save()
+            except OSError as e:
+                logging.warning(f"キャッシュを保存できませんでした: {e}")
+
+    def newest(self, prefix): # prefixで始まるキーのうち最後に保存した値（期限切れを含む）
+        with self.lock:
+            entries = [entry for key, entry in self.load().items() if key.startswith(prefix)]
+        return max(entries, key=lambda entry: entry['stored_at']) if entries else None
+
+    def prune(self, prefix, keep): # prefixで始まるキーのうちkeep以外を削除
+        with self.lock:
+            entries = self.load()
+            stale_keys = [key for key in entries if key.startswith(prefix) and key != keep]
+            if not stale_keys:
+                return
+            for key in stale_keys:
+                del entries[key]
+            try:
+                self.save()
+            except OSError as e:
+                logging.warning(f"キャッシュを保存できませんでした: {e}")
+
+    def touch(self, key): # 更新がなかった場合に有効期限を延ばす
+        with self.lock:
+            entry = self.load().get(key)
+            if entry:
+                entry['stored_at'] = time.time()
+                try:
+                    self.save()
+                except OSError as e:
+                    logging.warning(f"キャッシュを保存できませんでした: {e}")
+
+local_cache = LocalCache('setup/cache.json')
+
+class GasCallCancelled(Exception):
+    # ユーザーの操作でGAS呼び出しを中止した
+    pass
+
+class RetryPolicy:
+    # GAS呼び出しの再試行の方針
+    # max_attempts回まで、最初の呼び出しからdeadline秒以内に収まる範囲で再試行する
+    # 待ち時間は指数バックオフ（base_delay * 2^n, 最大max_delay）＋ランダムジッター
+    # retry_statusesに含まれないHTTPステータスは再試行しない
+    def __init__(self, max_attempts=3, deadline=60, timeout=30, base_delay=1, max_delay=10, jitter=1, retry_statuses=(408, 429, 500, 502, 503, 504)):
+        self.max_attempts = max_attempts
+        self.deadline = deadline
+        self.timeout = timeout
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.retry_statuses = retry_statuses
+
+    def delay(self, attempt):
+        return min(self.max_delay, self.base_delay * (2 ** attempt)) + random.uniform(0, self.jitter)
+
+# 起動時の先読み（失敗しても各画面で取得し直すので再試行せず、最初の画面の表示を待たせない）
+STARTUP_POLICY = RetryPolicy(max_attempts=1, deadline=10, timeout=10)
+
+class GasRetry:
+    # 1回のGAS呼び出しの再試行の進め方（AutomationHandlerとAsyncAutomationClientで共通）
+    # 通信はそれぞれのクライアント（requests・httpx）で行い、中止・試行回数の通知・期限・待ち時間・応答の判定はここで行う
+    #   for attempt in retry.attempts(): 通信 → retry.accept(...) または retry.failed(...) → retry.next_delay(attempt)で待つ
+    def __init__(self, handler, function_name, policy=None):
+        self.handler = handler
+        self.function_name = function_name
+        self.policy = policy or RetryPolicy()
+        self.deadline = time.monotonic() + self.policy.deadline
+        self.last_error = None
+
+    def attempts(self):
+        for attempt in range(self.policy.max_attempts):
+            self.check_cancelled()
+            if self.handler.gas_progress:
+                self.handler.gas_progress(self.function_name, attempt + 1, self.policy.max_attempts)
+            yield attempt
+
+    def check_cancelled(self):
+        if self.handler.cancel_event.is_set():
+            raise GasCallCancelled(f"{self.function_name}の呼び出しが中止されました")
+
+    def timeout(self, start): # 全体の期限を超えないタイムアウト
+        return max(1, min(self.policy.timeout, self.deadline - start))
+
+    def accept(self, attempt, start, status_code, text):
+        # 応答が成功（200）ならTrue、再試行する場合はFalse。再試行しても結果が変わらないエラーは例外
+        self.handler.record_gas_latency(self.function_name, start, status_code, attempt)
+        if status_code == 200:
+            self.check_cancelled() # 応答待ちの間に中止された
+            return True
+        logging.warning(f"Attempt {attempt + 1} failed: {text}")
+        self.last_error = Exception(f"Google Apps Script呼び出しエラー: {status_code} {text}")
+        if status_code not in self.policy.retry_statuses:
+            raise self.last_error
+        return False
+
+    def failed(self, attempt, start, error): # 通信エラー・タイムアウト・JSONでない応答
+        self.handler.record_gas_latency(self.function_name, start, None, attempt)
+        logging.warning(f"Attempt {attempt + 1} failed: {error}")
+        self.last_error = error
+
+    def next_delay(self, attempt):
+        # 次の試行までの待ち時間（再試行しない場合はNone）
+        delay = self.policy.delay(attempt)
+        if attempt == self.policy.max_attempts - 1 or time.monotonic() + delay >= self.deadline:
+            return None
+        logging.info(f"Retrying {self.function_name} in {delay:.2f} seconds...")
+        return delay
+
+    def wait(self, delay): # 待ち時間中も中止できる
+        if self.handler.cancel_event.wait(delay):
+            raise GasCallCancelled(f"{self.function_name}の呼び出しが中止されました")
+
+    def give_up(self):
+        logging.error(f"Max attempts reached. Raising exception.")
+        return self.last_error
+
+class DownloadWatcher:
+    # ダウンロード完了の監視
+    # watchdogがあればファイルの変更通知で即座に確認し、なければpoll_intervalごとに確認する
+    # 完了の条件: ファイルが存在し、.crdownloadがなく、サイズが変化しなくなったこと
+    def __init__(self, file_path, timeout=30, poll_interval=0.1, settle=0.05):
+        self.file_path = file_path
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.settle = settle
+        self.changed = threading.Event()
+
+    def dispatch(self, event): # watchdogからの通知
+        self.changed.set()
+
+    def completed_size(self):
+        if os.path.exists(f'{self.file_path}.crdownload') or not os.path.exists(self.file_path):
+            return None
+        return os.path.getsize(self.file_path)
+
+    def wait(self):
+        deadline = time.monotonic() + self.timeout
+        observer = None
+        if Observer is not None:
+            try:
+                observer = Observer()
+                observer.schedule(self, os.path.dirname(self.file_path) or '.', recursive=False)
+                observer.start()
+            except Exception as e:
+                logging.warning(f'ダウンロードフォルダの監視を開始できませんでした: {e}')
+                observer = None
+        try:
+            while True:
+                size = self.completed_size()
+                if size is not None:
+                    time.sleep(self.settle) # 書き込み中でないことをサイズの変化で確認
+                    if self.completed_size() == size:
+                        return True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f'ダウンロードが{self.timeout}秒以内に完了しませんでした: {self.file_path}')
+                self.changed.wait(min(self.poll_interval if observer is None else 1.0, remaining))
+                self.changed.clear()
+        finally:
+            if observer is not None:
+                observer.stop()
+                observer.join()
+
 class AutomationHandler:
-    def __init__(self):
+    def __init__(self, settings=None):
+        # 店舗の設定（省略時はsetup/config.iniのSettings。複数店舗の一括実行では店舗ごとの設定を渡す）
+        self.st = default_settings() if settings is None else settings
         # Google Apps ScriptのエンドポイントURL
-        self.script_url = 'https://script.google.com/macros/s/AKfycbwrdCpKUelDpHukcwgw2e2Nt04nmonpYhUfMQKLSL2ZhXwEHqp0yXlHpoRekPYn_i5EOg/exec'
+        self.script_url = self.st.get('SCRIPT_URL', 'https://script.google.com/macros/s/AKfycbwrdCpKUelDpHukcwgw2e2Nt04nmonpYhUfMQKLSL2ZhXwEHqp0yXlHpoRekPYn_i5EOg/exec')
+        # アップデート（version.json・インストーラー）の配布元
+        self.update_url = self.st.get('UPDATE_URL', 'https://support.iwasadigital.com/kaos/')
+        # EOSのURL（EOS_MODE = replicaの場合は動作確認用のEOSの代替（eos_replica.py）に接続する）
+        if self.st.get('EOS_MODE', 'live') == 'replica':
+            self.eos_url = self.st.get('EOS_REPLICA_URL', 'http://127.0.0.1:8765/st/')
+        else:
+            self.eos_url = 'https://eos-st.komeda.co.jp/st/'
         self.driver = None
+        self.browser_profile = None # 起動中のブラウザの起動プロファイル
+        self.version_manifest = None # 最後に取得したversion.json
+        self.cache = local_cache
+        self.cancel_event = threading.Event() # セットするとGAS呼び出しの再試行を中止する
+        self.gas_progress = None # GAS呼び出しの試行ごとに呼ばれる関数 (関数名, 試行回数, 最大試行回数)
+        self.sheet_values = {} # 発注書ごとに最後に取得したシートの値 {sheet_id: {'revision', 'values_food', 'values_nonfood'}}
+        self.order_plans = [] # get_spreadsheetで作成するOrderPlan（食品・非食品）
+        self.last_order_plans = {} # 前回入力したOrderPlan {kind: plan}
+        self.timeline = RunTimeline(self.st.get('SHOP_NAME', '')) # 処理時間の記録（保存先はtimeline.pathで指定）
 
+    @traced()
     def check_update(self, store_name, current_version): # return need_update, self.latest_version
+        # version.jsonはキャッシュし、期限切れの場合はETag/Last-Modifiedで更新の有無だけを確認する
+        # 取得に失敗した場合は最後に取得したversion.jsonを使う
         try:
-            response = requests.get("https://support.iwasadigital.com/kaos/version.json")
-            logging.info(response.json())
-            print(response.status_code)
-            if response.status_code == 200:
-                versions = response.json()
-                if store_name not in versions:
-                    latest_version = versions.get('default')
-                else:
-                    latest_version = versions.get(store_name)
-                if latest_version and latest_version != current_version:
-                    return True, latest_version
-                else:
-                    return False, None
-            else:
-                logging.error(f"Error during version check: {response.text}")
-                return False, None
-        except requests.exceptions.RequestException as e: # 通信エラー
-            logging.error(f"Error during version check: {e}")
-            return False, 404
+            entry = self.cache.fresh('version', CACHE_TTL['version'])
+            versions = entry['value'] if entry else self.fetch_versions()
         except Exception as e:
             logging.error(f"Error during version check: {e}")
+            entry = self.cache.last('version')
+            if entry is None:
+                return False, (404 if isinstance(e, requests.exceptions.RequestException) else None) # 404: 通信エラー
+            logging.info("最後に取得したversion.jsonを使用します")
+            versions = entry['value']
+        self.version_manifest = versions
+        if store_name not in versions:
+            latest_version = versions.get('default')
+        else:
+            latest_version = versions.get(store_name)
+        if latest_version and latest_version != current_version:
+            return True, latest_version
+        else:
             return False, None
+
+    def fetch_versions(self):
+        entry = self.cache.last('version')
+        headers = {}
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        response = http_session().get(f"{self.update_url}version.json", headers=headers, timeout=10)
+        print(response.status_code)
+        if response.status_code == 304: # 更新なし
+            self.cache.touch('version')
+            return entry['value']
+        if response.status_code != 200:
+            raise Exception(response.text)
+        versions = response.json()
+        logging.info(versions)
+        self.cache.set('version', versions, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        return versions
+
+    def cached_call(self, key, ttl, fetch):
+        # GASの呼び出し結果をttl秒キャッシュする。呼び出しに失敗した場合は最後に取得した値を使う
+        entry = self.cache.fresh(key, ttl)
+        if entry:
+            return entry['value']
+        try:
+            return self.store_cached(key, fetch())
+        except GasCallCancelled:
+            raise
+        except Exception as e:
+            return self.last_cached(key, e)
+
+    def store_cached(self, key, value): # cached_call（非同期版と共通）: 取得した値を保存
+        if 'error' in value:
+            raise Exception(value['error'])
+        self.cache.set(key, value)
+        return value
+
+    def last_cached(self, key, error): # cached_call（非同期版と共通）: 取得に失敗した場合の最後に取得した値
+        entry = self.cache.last(key)
+        if entry is None:
+            raise error
+        logging.warning(f"{key}の取得に失敗したため最後に取得した値を使用します: {error}")
+        return entry['value']
         
-    def download_updater(self, latest_version, installer_path):
+    @traced()
+    def download_updater(self, latest_version, installer_path, progress=None):
+        # インストーラを少しずつダウンロードして.partに書き込み、通信が切れた場合はRangeで続きから再開する
+        # version.jsonにsha256があれば照合し、一致した場合のみinstaller_pathにリネームする
+        # progress(受信済みバイト数, 全体のバイト数またはNone)で進捗を通知
+        part_path = f'{installer_path}.part'
         try:
-            files = glob.glob('setup/KAOS_setup.*.exe')
+            files = glob.glob('setup/KAOS_setup.*.exe') + [file for file in glob.glob('setup/KAOS_setup.*.exe.part') if os.path.normpath(file) != os.path.normpath(part_path)]
             for file in files:
                 os.remove(file)
-            url = f"https://support.iwasadigital.com/kaos/{latest_version}/KAOS_setup.{latest_version}.exe"
-            response = requests.get(url)
-            logging.info(f"Response status code: {response.status_code}")
-            with open(installer_path, 'wb') as file:
-                file.write(response.content)
+            url = f"{self.update_url}{latest_version}/KAOS_setup.{latest_version}.exe"
+            max_attempts = 5
+            for attempt in range(max_attempts):
+                downloaded = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+                headers = {'Range': f'bytes={downloaded}-'} if downloaded else {}
+                try:
+                    with http_session().get(url, headers=headers, stream=True, timeout=(10, 60)) as response:
+                        logging.info(f"Response status code: {response.status_code} (再開位置: {downloaded})")
+                        if response.status_code == 416: # 既に全体を受信済み
+                            break
+                        response.raise_for_status()
+                        if response.status_code != 206: # Range非対応の場合は最初から
+                            downloaded = 0
+                        content_range = response.headers.get('Content-Range', '')
+                        if content_range and not content_range.endswith('/*'):
+                            total = int(content_range.rsplit('/', 1)[1])
+                        elif response.headers.get('Content-Length'):
+                            total = downloaded + int(response.headers['Content-Length'])
+                        else:
+                            total = None
+                        with open(part_path, 'ab' if downloaded else 'wb') as file:
+                            for chunk in response.iter_content(chunk_size=65536):
+                                file.write(chunk)
+                                downloaded += len(chunk)
+                                self.timeline.add_bytes(len(chunk))
+                                if progress:
+                                    progress(downloaded, total)
+                    break
+                except requests.exceptions.RequestException as e:
+                    if attempt == max_attempts - 1:
+                        raise
+                    logging.warning(f"Download interrupted ({attempt + 1}/{max_attempts}): {e}")
+                    time.sleep(min(2 ** attempt, 10))
+
+            expected_sha256 = self.installer_sha256(latest_version)
+            if expected_sha256:
+                sha256 = hashlib.sha256()
+                with open(part_path, 'rb') as file:
+                    for block in iter(lambda: file.read(1024 * 1024), b''):
+                        sha256.update(block)
+                if sha256.hexdigest().lower() != expected_sha256.lower():
+                    os.remove(part_path) # 壊れたファイルから再開しないように削除
+                    raise Exception(f"sha256が一致しません: {sha256.hexdigest()}")
+            else:
+                logging.info(f"version.jsonに{latest_version}のsha256がないため照合をスキップします")
+            os.replace(part_path, installer_path)
             return True
         except Exception as e:
             logging.error(f"Error during dounloading updater: {e}")
             return False
+
+    def installer_sha256(self, latest_version):
+        # version.jsonの"sha256": {"バージョン": "ハッシュ値"}から取得
+        manifest = self.version_manifest or {}
+        sha256_dict = manifest.get('sha256')
+        if isinstance(sha256_dict, dict):
+            return sha256_dict.get(latest_version)
+        return None
     
-    def call_google_script(self, function_name, params):
-        max_retries = 3
+    def call_google_script(self, function_name, params, policy=None):
+        # policy: 再試行の方針（省略時はRetryPolicy()）
+        # 再試行の待ち時間中もself.cancel_eventで中止でき、self.gas_progressに試行回数を通知する
+        with self.timeline.span(f'gas:{function_name}'):
+            return self.call_google_script_with_policy(function_name, params, policy)
 
-        with requests.Session() as session:  # セッションを使用して接続を再利用
-            for attempt in range(max_retries):
-                try:
-                    response = session.post(
-                        self.script_url,
-                        json={
-                            'function': function_name,
-                            'parameters': params
-                        },
-                        headers={'Content-Type': 'application/json'},
-                        timeout=30  # タイムアウトを設定
-                    )
-                    if response.status_code == 200:
-                        logging.info(f"Response JSON from GAS: {response.json()}")
-                        return response.json()
-                    else:
-                        logging.warning(f"Attempt {attempt + 1} failed: {response.text}")
-                        raise Exception(f"Google Apps Script呼び出しエラー: {response.text}")
-                except Exception as e:
-                    if attempt < max_retries - 1:
-                        delay = (2 ** attempt) + random.uniform(0, 1)  # 指数バックオフ＋ランダムジッター
-                        logging.info(f"Retrying in {delay:.2f} seconds...")
-                        time.sleep(delay)
-                    else:
-                        logging.error(f"Max attempts reached. Raising exception.")
-                        raise e
+    def call_google_script_with_policy(self, function_name, params, policy):
+        retry = GasRetry(self, function_name, policy)
+        session = http_session()  # プロセス全体で共有するセッションで接続を再利用
+        for attempt in retry.attempts():
+            start = time.monotonic()
+            try:
+                response = session.post(
+                    self.script_url,
+                    json={
+                        'function': function_name,
+                        'parameters': params
+                    },
+                    headers={'Content-Type': 'application/json'},
+                    timeout=retry.timeout(start)
+                )
+                self.timeline.add_bytes(len(response.request.body or b'') + len(response.content))
+                if retry.accept(attempt, start, response.status_code, response.text):
+                    logging.info(f"Response JSON from GAS: {response.json()}")
+                    return response.json()
+            except requests.exceptions.RequestException as e: # 通信エラー・タイムアウト・JSONでない応答
+                retry.failed(attempt, start, e)
+            delay = retry.next_delay(attempt)
+            if delay is None:
+                break
+            retry.wait(delay)
+        raise retry.give_up()
+
+    def record_gas_latency(self, function_name, start, status_code, attempt):
+        seconds = time.monotonic() - start
+        gas_call_log.append({'function': function_name, 'seconds': seconds, 'status': status_code, 'attempt': attempt + 1})
+        logging.info(f"GAS {function_name}: {seconds:.2f}秒 (status: {status_code}, attempt: {attempt + 1})")
         
+    def gas_batch_supported(self): # GASがbatch関数に対応しているか（None: 未確認）
+        entry = self.cache.fresh('gas_batch_supported', CACHE_TTL['gas_batch'])
+        return None if entry is None else entry['value']
+
+    def set_gas_batch_supported(self, supported):
+        # 確認結果はキャッシュに保存し、起動のたびに対応していないbatchを呼び出さない
+        if self.gas_batch_supported() != supported:
+            self.cache.set('gas_batch_supported', supported)
+
+    def call_google_script_batch(self, calls, policy=None):
+        # 複数のGAS関数を1回のPOSTで呼び出す
+        # calls: {名前: (関数名, パラメータ)}, 戻り値: {名前: レスポンス}
+        # GAS側がbatchに対応していない場合は、各関数を並行して呼び出す
+        # batchの通信に失敗した場合は、個別に呼び出しても失敗するので例外を返す
+        if self.gas_batch_supported() is not False:
+            response = self.call_google_script('batch', {
+                'calls': [{'name': name, 'function': function_name, 'parameters': params} for name, (function_name, params) in calls.items()]
+            }, policy)
+            if 'results' in response:
+                self.set_gas_batch_supported(True)
+                return response['results']
+            logging.info(f"GASがbatchに対応していないため個別に呼び出します: {response}")
+            self.set_gas_batch_supported(False)
+        with ThreadPoolExecutor(max_workers=len(calls)) as executor:
+            futures = {name: executor.submit(self.call_google_script, function_name, params, policy) for name, (function_name, params) in calls.items()}
+            return {name: future.result() for name, future in futures.items()}
+
+    def prefetched_notices(self, version, today_int, cached_notices, response):
+        # AsyncAutomationClient.prefetch_startupのお知らせ（キャッシュ・取得結果・最後に取得した値の順に使う）
+        if cached_notices is not None:
+            return {'notices': self.parse_notices(cached_notices['value'])}
+        if response is not None and 'error' not in response:
+            return {'notices': self.parse_notices(self.store_notices(version, today_int, response))}
+        return {'notices': self.last_notices(version, response)}
+
+    @traced()
     def get_original_sheet(self):
-        params = {'shopName': st['SHOP_NAME']}
-        response = self.call_google_script('getOriginalSheet', params)
+        params = {'shopName': self.st['SHOP_NAME']}
+        response = self.cached_call(f"original_sheet:{self.st['SHOP_NAME']}", CACHE_TTL['original_sheet'], lambda: self.call_google_script('getOriginalSheet', params))
         if response['found']:
             return response['sheet_url']
         else:
             return False
-        
-    def get_notices(self, version, today_int):
-        params = {
+
+    def notices_key(self, version, today_int):
+        # お知らせのキャッシュのキー（GASには日付を送り、日付によって表示するお知らせが変わるので日付ごとに保存する）
+        return f"notices:{version}:{today_int.strftime('%Y-%m-%d')}"
+
+    def store_notices(self, version, today_int, response):
+        # 取得したお知らせを保存し、前の日付・前のバージョンのお知らせは削除する（cache.jsonが日ごとに増えないように）
+        key = self.notices_key(version, today_int)
+        self.store_cached(key, response)
+        self.cache.prune('notices:', key)
+        return response
+
+    def last_notices(self, version, error):
+        # お知らせを取得できなかった場合は、同じバージョンで最後に取得したお知らせ（前の日付を含む）を使う
+        # 1度も取得していない場合はFalse（お知らせなし）とし、起動を止めない
+        entry = self.cache.newest(f'notices:{version}:')
+        if entry is None:
+            logging.warning(f"お知らせを取得できませんでした: {error}")
+            return False
+        logging.warning(f"お知らせの取得に失敗したため最後に取得した値を使用します: {error}")
+        return self.parse_notices(entry['value'])
+
+    def notice_params(self, version, today_int):
+        return {
             'now': today_int.isoformat(),
             'version': version}
-        response = self.call_google_script('getNotice', params)
+
+    def parse_notices(self, response):
         if 'error' in response or len(response['notices']) == 0:
             return False
         else:
             return response['notices']
 
-    def check_existing_sheet(self, sheet_name):
-        params = {
-            'shopName': st['SHOP_NAME'],
+    @traced()
+    def get_notices(self, version, today_int):
+        entry = self.cache.fresh(self.notices_key(version, today_int), CACHE_TTL['notices'])
+        if entry:
+            return self.parse_notices(entry['value'])
+        try:
+            response = self.call_google_script('getNotice', self.notice_params(version, today_int))
+            return self.parse_notices(self.store_notices(version, today_int, response))
+        except GasCallCancelled:
+            raise
+        except Exception as e:
+            return self.last_notices(version, e)
+
+    def existing_sheet_params(self, sheet_name):
+        return {
+            'shopName': self.st['SHOP_NAME'],
             'sheet_name': sheet_name
         }
-        response = self.call_google_script('checkExistingSheet', params)
+
+    def parse_existing_sheet(self, response):
         if 'found' in response:
             if response['found']:
                 return response['sheet_id'], response['spreadsheet_url']
@@ -142,45 +674,74 @@ class AutomationHandler:
         else:
             logging.error(f"Error in checking existing sheet: {response}")
             return False
+
+    @traced()
+    def check_existing_sheet(self, sheet_name):
+        response = self.call_google_script('checkExistingSheet', self.existing_sheet_params(sheet_name))
+        return self.parse_existing_sheet(response)
                 
+    def browser_options(self, profile):
+        # Chromeの起動オプション
+        # visible: 発注入力用の通常のウィンドウ
+        # lean: CSVダウンロード用の軽量プロファイル（ヘッドレス, 画像・Webフォントなし, eager読み込み）
+        options = Options()
+        prefs = {}
+        download_dir = self.st.get('DOWNLOAD_DIR', '')
+        if download_dir:
+            os.makedirs(download_dir, exist_ok=True)
+            prefs['download.default_directory'] = os.path.abspath(download_dir)
+            prefs['download.prompt_for_download'] = False
+            prefs['download.directory_upgrade'] = True
+        if profile == 'lean':
+            if self.st.get('HEADLESS', 'True') == 'True':
+                options.add_argument('--headless=new')
+                options.add_argument('--window-size=1280,1024')
+            if self.st.get('LOAD_IMAGES', 'False') != 'True':
+                prefs['profile.managed_default_content_settings.images'] = 2
+                options.add_argument('--blink-settings=imagesEnabled=false')
+                options.add_argument('--disable-remote-fonts')
+            options.page_load_strategy = self.st.get('PAGE_LOAD_STRATEGY', 'eager')
+        else:
+            options.add_experimental_option('detach', True)
+        if prefs:
+            options.add_experimental_option('prefs', prefs)
+        return options
+
     # EOSログインメソッド
-    def login_eos(self, user_id, password):
+    @traced()
+    def login_eos(self, user_id, password, profile='visible'):
         try:
             if self.driver is not None:
                 self.driver.quit()  # 既存のドライバーを確実にクローズ
                 self.driver = None
 
-            options = Options()
-            options.add_experimental_option('detach', True)
-            self.driver = webdriver.Chrome(options=options)
-            self.driver.minimize_window() #誤操作を防ぐためにウィンドウを最小化
+            with self.timeline.span('chrome_start', profile=profile):
+                load_selenium()
+                self.driver = self.timeline.watch_driver(webdriver.Chrome(options=self.browser_options(profile)))
+            self.browser_profile = profile
+            if profile == 'visible':
+                self.driver.minimize_window() #誤操作を防ぐためにウィンドウを最小化
             
             # EOSにログイン
-            try:
-                self.driver.get('https://eos-st.komeda.co.jp/st/')
-                WebDriverWait(self.driver, 10).until(EC.presence_of_element_located((By.ID, 'txtUserId'))).send_keys(user_id) #ユーザーID入力
-                WebDriverWait(self.driver, 10).until(EC.presence_of_element_located((By.ID, 'txtPassword'))).send_keys(password) #パスワード入力
-                self.driver.find_element(By.ID, 'btnLogin').click() #「ログイン」ボタンクリック    
-            except TimeoutException: # 別ページでEOSが開かれていた場合、TimeoutExceptionとなる
-                self.driver.get('https://eos-st.komeda.co.jp/st/')
+            # ログイン画面・別ページで開かれている場合の画面（btnNext）・ログイン済みのいずれかが表示されたらすぐに進む
+            self.driver.get(self.eos_url)
+            page = self.wait_any(self.eos_page_conditions('login_form', 'already_open', 'logged_in'), timeout=10)
+            if page == 'login_form':
+                self.driver.find_element(By.ID, 'txtUserId').send_keys(user_id) #ユーザーID入力
+                self.driver.find_element(By.ID, 'txtPassword').send_keys(password) #パスワード入力
+                self.driver.find_element(By.ID, 'btnLogin').click() #「ログイン」ボタンクリック
+                page = self.wait_any(self.eos_page_conditions('logged_in', 'login_error', 'already_open'), timeout=8)
+            if page == 'already_open': # 別ページでEOSが開かれていた場合
+                logging.info('EOSが別ページで開かれています')
                 self.driver.find_element(By.ID, 'btnNext').click() #「開く」ボタンクリック
-                logging.info('TimeoutException')        
-            for _ in range(4):
-                try:
-                    WebDriverWait(self.driver, 2).until(EC.url_to_be('https://eos-st.komeda.co.jp/st/osirase'))
-                    break
-                except TimeoutException:
-                    if len(self.driver.find_elements(By.XPATH, value="//div[contains(text(), 'ユーザーまたはパスワードが一致しませんでした')]"))>0 :
-                        logging.warning('入力エラーダダイアログdetected')
-                        return "E0007" # ログインエラー
-            # ログイン成功の確認
-            WebDriverWait(self.driver, 1).until(EC.url_to_be('https://eos-st.komeda.co.jp/st/osirase'))
+                page = self.wait_any(self.eos_page_conditions('logged_in', 'login_error'), timeout=8)
+            if page == 'login_error':
+                logging.warning('入力エラーダダイアログdetected')
+                return "E0007" # ログインエラー
             logging.info('EOSログイン成功')
             
             # お知らせが表示される場合は✕ボタン
-            while len(self.driver.find_elements(By.XPATH, value="//button[@title='Close']"))>0 :
-                self.driver.find_element(By.XPATH, value="//button[@title='Close']").click()
-                time.sleep(0.05)
+            self.close_dialogs()
 
             return "200" # OK
             
@@ -190,32 +751,103 @@ class AutomationHandler:
                 self.driver.quit()
                 self.driver = None
             return "E0007"  # ログインエラー
+
+    def wait_any(self, conditions, timeout=10, poll_frequency=0.1):
+        # conditions: {名前: 条件（driverを受け取りTrueを返す関数）}
+        # いずれかの条件を満たした時点でその名前を返す。timeout秒以内に満たさない場合はTimeoutException
+        def first_met(driver):
+            for name, condition in conditions.items():
+                if condition(driver):
+                    return name
+            return False
+        return WebDriverWait(self.driver, timeout, poll_frequency=poll_frequency).until(first_met)
+
+    def eos_page_conditions(self, *names):
+        # wait_anyで使うEOSの画面の判定
+        conditions = {
+            'logged_in': EC.url_to_be(f'{self.eos_url}osirase'),
+            'login_error': lambda driver: len(driver.find_elements(By.XPATH, "//div[contains(text(), 'ユーザーまたはパスワードが一致しませんでした')]")) > 0,
+            'already_open': lambda driver: len(driver.find_elements(By.ID, 'btnNext')) > 0,
+            'login_form': lambda driver: len(driver.find_elements(By.ID, 'txtUserId')) > 0
+        }
+        return {name: conditions[name] for name in names}
+
+    def close_dialogs(self, max_rounds=10):
+        # 表示されているお知らせの✕ボタンをまとめてクリックし、閉じた数を返す
+        # ダイアログを閉じると次のお知らせが表示される場合があるので、表示されなくなるまで繰り返す（最大max_rounds回）
+        closed = 0
+        for _ in range(max_rounds):
+            count = self.driver.execute_script("""
+                const buttons = Array.from(document.querySelectorAll("button[title='Close']")).filter((button) => button.offsetParent !== null);
+                buttons.forEach((button) => button.click());
+                return buttons.length;""")
+            if count == 0:
+                break
+            closed += count
+        return closed
+
+    def js_click(self, locator, condition=None, timeout=10):
+        # 要素がcondition（省略時は存在すること）を満たすまで待ち、画面中央にスクロールしてJavaScriptでクリック
+        # .click()だと画面サイズなどによってうまくいかない場合があるので、JavaScriptでクリックを強制実行
+        condition = condition or EC.presence_of_element_located
+        element = WebDriverWait(self.driver, timeout, poll_frequency=0.1).until(condition(locator))
+        self.driver.execute_script("arguments[0].scrollIntoView({block: 'center'}); arguments[0].click();", element)
+        return element
+
+    def is_eos_session_alive(self):
+        # ブラウザが開いていて、EOSにログイン済みか確認
+        if self.driver is None:
+            return False
+        try:
+            current_url = self.driver.current_url
+            if not current_url.startswith(self.eos_url) or current_url == self.eos_url:
+                return False # EOS以外の画面またはログイン画面
+            if len(self.driver.get_cookies()) == 0:
+                return False
+            # 表示中の画面は発注書の編集前に読み込んだものなので、サーバー側でセッションが切れていないかお知らせ画面を読み込み直して確認
+            self.driver.get(f'{self.eos_url}osirase')
+            conditions = self.eos_page_conditions('login_form', 'already_open')
+            conditions['menu'] = lambda driver: len(driver.find_elements(By.CLASS_NAME, 'menupng2')) > 0
+            if self.wait_any(conditions, timeout=10) != 'menu':
+                return False # セッション切れでログイン画面に戻されている
+            self.close_dialogs()
+            return True
+        except Exception as e: # ブラウザが手動で閉じられた場合・画面が表示されない場合など
+            logging.info(f'EOSセッションを確認できませんでした: {e}')
+            return False
+
+    def ensure_eos_session(self, user_id, password, profile='visible'):
+        # 既存のブラウザとEOSセッションを再利用し、切れている場合のみログインし直す
+        # 起動プロファイルが異なる場合（ヘッドレス→通常など）はブラウザを起動し直す
+        if self.browser_profile == profile and self.is_eos_session_alive():
+            logging.info('既存のEOSセッションを再利用')
+            return "200" # OK
+        return self.login_eos(user_id, password, profile)
             
     def download_folder_path(self):
-        sub_key = r'SOFTWARE\Microsoft\Windows\CurrentVersion\Explorer\Shell Folders'
-        key = winreg.OpenKey(winreg.HKEY_CURRENT_USER, sub_key)
-        download_folder = winreg.QueryValueEx(key, '{374DE290-123F-4565-9164-39C4925E467B}')[0]
-        return download_folder
+        # config.iniでDOWNLOAD_DIRが指定されている場合はそのフォルダにダウンロードする
+        if self.st.get('DOWNLOAD_DIR', ''):
+            return os.path.abspath(self.st['DOWNLOAD_DIR'])
+        return downloads_folder() # OSのダウンロードフォルダ
             
+    @traced()
     def download_csv(self, today_str_csv, today_int):
-        login_status_code = self.login_eos(st['EOS_ID'], st['EOS_PW']) #EOSログインメソッド↑
+        # CSVダウンロードは画面表示が不要なので、DOWNLOAD_PROFILE = leanで軽量プロファイルを使える
+        from order_data import read_eos_csv, filter_delivery_date
+        login_status_code = self.ensure_eos_session(self.st['EOS_ID'], self.st['EOS_PW'], self.st.get('DOWNLOAD_PROFILE', 'visible')) #EOSログインメソッド↑
         logging.info(f'login_status_code(download_csv): {login_status_code}')
         if login_status_code != "200":
             return login_status_code # ログインエラー(E0007:IDorパスワード誤り)
         download_folder = self.download_folder_path()
         self.csv_path = os.path.join(download_folder, f'{today_str_csv}_発注.CSV')
         try:
+            # CSV_EXPORT_PATHが設定されている場合は、画面操作をせずにHTTPで直接ダウンロード
+            if not os.path.exists(self.csv_path) and self.st.get('CSV_EXPORT_PATH', ''):
+                self.download_csv_http(today_int) # 失敗した場合は下の画面操作でダウンロード
             if not os.path.exists(self.csv_path): 
                 # 左メニューの発注照会をクリック
-                menupng2 = WebDriverWait(self.driver, 15).until(EC.presence_of_element_located((By.CLASS_NAME, 'menupng2'))) #発注
-                self.driver.execute_script("arguments[0].scrollIntoView({block: 'center'});", menupng2)
-                time.sleep(0.3)
-                self.driver.execute_script("arguments[0].click();", menupng2)  # .click()だと画面サイズなどによってうまくいかない場合があるので、JavaScriptでクリックを強制実行
-                
-                inquiry_element = WebDriverWait(self.driver, 10).until(EC.presence_of_element_located((By.XPATH, "//a[@accesskey='4']")))
-                self.driver.execute_script("arguments[0].scrollIntoView({block: 'center'});", inquiry_element)
-                time.sleep(0.3)
-                self.driver.execute_script("arguments[0].click();", inquiry_element)  # JavaScriptでクリックを強制実行
+                self.js_click((By.CLASS_NAME, 'menupng2'), timeout=15) #発注
+                self.js_click((By.XPATH, "//a[@accesskey='4']"))
 
                 # 前々日の日付を計算
                 day_before_yesterday_int = today_int - timedelta(days=2)
@@ -245,94 +877,111 @@ class AutomationHandler:
                         select_from.select_by_value(day_before_yesterday_year)
 
                 # 発注明細を照会
-                inquiry_button = WebDriverWait(self.driver, 10).until(EC.element_to_be_clickable((By.ID, 'inquiryButton')))
-                self.driver.execute_script("arguments[0].scrollIntoView({block: 'center'});", inquiry_button)
-                time.sleep(0.3)
-                self.driver.execute_script("arguments[0].click();", inquiry_button)  # JavaScriptでクリックを強制実行
+                self.js_click((By.ID, 'inquiryButton'), EC.element_to_be_clickable)
 
                 # 画面の一番下までスクロール
                 self.driver.execute_script("document.body.style.zoom='65%'")
                 self.driver.execute_script('window.scrollTo(0, document.body.scrollHeight);')
                     
                 # CSVをダウンロード
-                btn_csv_out = WebDriverWait(self.driver, 10).until(EC.element_to_be_clickable((By.ID, 'btnCsvoutConfirm')))
-                self.driver.execute_script("arguments[0].scrollIntoView({block: 'center'});", btn_csv_out)
-                time.sleep(0.5)
-                self.driver.execute_script("arguments[0].click();", btn_csv_out)  # JavaScriptでクリックを強制実行 
+                self.js_click((By.ID, 'btnCsvoutConfirm'), EC.element_to_be_clickable)
                 
                 # ウィジェットのはいをクリック
-                btn_yes = WebDriverWait(self.driver, 10).until(EC.presence_of_element_located((By.XPATH, "//*[text()='はい']")))
-                self.driver.execute_script("arguments[0].scrollIntoView({block: 'center'});", btn_yes)
-                time.sleep(0.3)  # 少し待機
-                self.driver.execute_script("arguments[0].click();", btn_yes)
-
-            max_retry_download = 15
-            retry_download = 0
-            # 前日の発注明細をロード
-            while retry_download <= max_retry_download:
-                if os.path.exists(self.csv_path):
-                    break
-                elif retry_download == max_retry_download:
-                    raise Exception("retry_download reached max_retry_download")
-                else:
-                    retry_download += 1
-                    time.sleep(0.1)
+                self.js_click((By.XPATH, "//*[text()='はい']"), EC.visibility_of_element_located)
+
+            # 前日の発注明細のダウンロード完了を待つ
+            DownloadWatcher(self.csv_path, timeout=float(self.st.get('DOWNLOAD_TIMEOUT', '30'))).wait()
+            self.timeline.add_bytes(os.path.getsize(self.csv_path))
         except:
             return "E0005" # ダウンロードエラー
         
         next_day = today_int + timedelta(days=1)
-        days_jp = ['月', '火', '水', '木', '金', '土', '日']
-        next_day_str = next_day.strftime('%Y-%m-%d') + f'({days_jp[next_day.weekday()]})'  # 日本語曜日を手動で追加
-
-        logging.info(f"next_day_str: {next_day_str}")
+        logging.info(f"next_day: {next_day.strftime('%Y-%m-%d')}")
         try:
-            with open(self.csv_path, 'r', encoding='utf-8') as file:
-                df = pd.read_csv(file)
+            df = read_eos_csv(self.csv_path, engine=self.st.get('CSV_ENGINE', 'c'))
             logging.info(df)
         except FileNotFoundError:
             logging.error(f"Error: {self.csv_path} が見つかりませんでした。")
             return "E0006"
-        # 納品予定日が翌日のデータをフィルタリング
-        filtered_df = df[(df['納品予定日'] == next_day_str) | (df['納品日'] == next_day_str)] # 納品予定日に
+        # 納品予定日が翌日のデータをフィルタリング（曜日付きの文字列ではなく日付で比較）
+        filtered_df = filter_delivery_date(df, next_day)
         logging.info('filtered data:')
         logging.info(filtered_df)
 
-        self.filtered_csv_path = self.csv_path.replace('.CSV', '_filtered.CSV')
+        # フィルタリング結果はメモリ上に保持し、generate_formでそのまま送信する
+        self.filtered_df = filtered_df
 
-        # CSVファイルに上書き保存
-        logging.info(f"{self.filtered_csv_path} にフィルタリング結果を上書き保存します。")
-        with open(self.filtered_csv_path, 'w', encoding='utf-8-sig') as file:
-            filtered_df.to_csv(file, index=False)
-        logging.info(f"{self.filtered_csv_path} にフィルタリング結果を上書き保存しました。")
+        # デバッグモードの場合のみ、フィルタリング結果をファイルに保存
+        if self.st.get('DEBUG', 'False') == 'True':
+            self.filtered_csv_path = self.csv_path.replace('.CSV', '_filtered.CSV')
+            with open(self.filtered_csv_path, 'w', encoding='utf-8-sig') as file:
+                filtered_df.to_csv(file, index=False)
+            logging.info(f"{self.filtered_csv_path} にフィルタリング結果を保存しました。")
 
-        self.driver.close()
-        self.driver.quit() 
-        self.driver = None  
+        # ブラウザは閉じずに、発注入力（input_order_in_site）でそのまま再利用する
 
         if os.path.exists(self.csv_path):
             return "200" # OK
         else:
             return "E0005" # ダウンロードエラー
 
+    def eos_http_session(self):
+        # ログイン済みのブラウザのCookieを引き継いだrequests.Sessionを作成
+        session = requests.Session()
+        session.headers['User-Agent'] = self.driver.execute_script('return navigator.userAgent;')
+        for cookie in self.driver.get_cookies():
+            session.cookies.set(cookie['name'], cookie['value'], path=cookie.get('path', '/'))
+        return session
+
+    @traced()
+    def download_csv_http(self, today_int):
+        # 発注明細の照会・CSV出力をHTTPで直接リクエストし、self.csv_pathに保存する
+        # 照会画面と同じく前々日から本日までの明細を対象にする
+        day_before_yesterday_int = today_int - timedelta(days=2)
+        params = {
+            'selectFromYaer': day_before_yesterday_int.strftime('%Y'), # サイトの方がスペルミスしている
+            'selectFromMonth': str(day_before_yesterday_int.month),
+            'selectFromDay': str(day_before_yesterday_int.day)
+        }
+        part_path = f'{self.csv_path}.part'
+        try:
+            with self.eos_http_session() as session:
+                inquiry_path = self.st.get('CSV_INQUIRY_PATH', '')
+                if inquiry_path:
+                    response = session.post(urljoin(self.eos_url, inquiry_path), data=params, timeout=30)
+                    response.raise_for_status()
+                with session.post(urljoin(self.eos_url, self.st['CSV_EXPORT_PATH']), data=params, stream=True, timeout=60) as response:
+                    response.raise_for_status()
+                    if 'text/html' in response.headers.get('Content-Type', ''): # セッション切れでログイン画面が返ってきた場合
+                        raise Exception(f"CSVではなくHTMLが返されました: {response.url}")
+                    with open(part_path, 'wb') as file:
+                        for chunk in response.iter_content(chunk_size=65536):
+                            file.write(chunk)
+                            self.timeline.add_bytes(len(chunk))
+            os.replace(part_path, self.csv_path)
+            logging.info(f"HTTPでCSVをダウンロードしました: {self.csv_path}")
+            return True
+        except Exception as e:
+            logging.warning(f"HTTPでのCSVダウンロードに失敗したため画面操作でダウンロードします: {e}")
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            return False
+
     def execute_with_retry(self, function_name, params, retries=3, timeout=120):
-        for attempt in range(retries):
-            try:
-                response = self.call_google_script(function_name, params)
-                return response
-            except Exception as e:
-                print(f"Attempt {attempt + 1} failed with error: {e}. Retrying...")
-                time.sleep(5)
-        raise Exception("All retry attempts failed")
+        # 時間のかかるGAS関数用。retries回まで、全体でtimeout秒以内に収まるように再試行する
+        policy = RetryPolicy(max_attempts=retries, deadline=timeout)
+        return self.call_google_script(function_name, params, policy)
            
+    @traced()
     def generate_form(self, delivery_date_int, today_str):
-        with open(self.filtered_csv_path, 'r', encoding='utf-8') as file:
-            csv_data = file.read()
+        # 従来のファイル経由（utf-8-sigで保存しutf-8で読み込み）と同じく先頭にBOMを付けて送信
+        csv_data = '\ufeff' + self.filtered_df.to_csv(index=False, lineterminator='\n')
 
         params = {
             'delivery_date_int': delivery_date_int.isoformat(),
             'csv_data': csv_data,
             'today_str': today_str,
-            'shop_name': st['SHOP_NAME']
+            'shop_name': self.st['SHOP_NAME']
         }
 
         response = self.execute_with_retry('generateForm', params, retries=5)
@@ -341,58 +990,73 @@ class AutomationHandler:
         else:
             return response['spreadsheetId'], response['spreadsheetUrl']
 
-    def get_spreadsheet(self, sheet_id):
+    def row_hashes(self, values):
+        # シートの各行のハッシュ（GAS側でJSON.stringifyした行のMD5と比較する）
+        if values is None:
+            return None
+        return [hashlib.md5(json.dumps(row, ensure_ascii=False, separators=(',', ':')).encode('utf-8')).hexdigest()[:8] for row in values]
+
+    def merge_sheet_rows(self, values, delta):
+        # 変更された行だけを前回の値に反映する
+        # delta: {'length': 行数, 'rows': {行番号: 行}}（行番号は見出し行を0とする）
+        if delta is None:
+            return values
+        merged = list(values or [])[:delta['length']]
+        merged += [[] for _ in range(delta['length'] - len(merged))]
+        for index, row in delta['rows'].items():
+            merged[int(index)] = row
+        return merged
+
+    def fetch_sheet_values(self, sheet_id):
+        # 発注書の値を取得する。2回目以降は前回のrevisionと行ごとのハッシュを送り、変更された行だけを受け取る
+        # GASが差分に対応していない場合は全体が返される
+        cached = self.sheet_values.get(sheet_id)
         params = {'sheet_id': sheet_id}
+        if cached is not None:
+            params['revision'] = cached['revision']
+            params['row_hashes'] = {'food': self.row_hashes(cached['values_food']),
+                                    'nonfood': self.row_hashes(cached['values_nonfood'])}
         response = self.execute_with_retry('getSpreadsheet', params, retries=5)
         if 'error' in response:
             raise Exception(f"Error in getting spreadsheet: {response['error']}")
+        if cached is not None and response.get('delta'):
+            values_food = self.merge_sheet_rows(cached['values_food'], response.get('food'))
+            values_nonfood = self.merge_sheet_rows(cached['values_nonfood'], response.get('nonfood'))
+            logging.info(f"getSpreadsheet: 変更された行 食品{len((response.get('food') or {}).get('rows', {}))}行 / 非食品{len((response.get('nonfood') or {}).get('rows', {}))}行")
         else:
             values_food = response.get('values_food')
             values_nonfood = response.get('values_nonfood', None)
-            # 指定した複数の列をDataFrameに変換
-            if not values_food:
-                print('No data found in the sheet.')
-                return False, False
-            else:
-                #食品
-                max_columns = len(values_food[0])
-                data = [row + [None] * (max_columns - len(row)) for row in values_food[1:]]
-                df_food = pd.DataFrame(data, columns=values_food[0])
-                self.input_df = df_food[['商品名', 'セット', '商品コード', '現在庫', '発注数']]
-                self.input_df.replace('', None, inplace=True)
-                self.input_df.dropna(subset=['商品コード'], inplace=True)
-                self.input_df['商品コード'] = self.input_df['商品コード'].astype(str).str.strip()
-                self.input_df['商品コード'] = pd.to_numeric(self.input_df['商品コード'], errors='coerce')
-                self.input_df.dropna(subset=['商品コード'], inplace=True)
-                Name_with_NaN = self.input_df[self.input_df['現在庫'].isna()]['商品名'].tolist()
-                if len(Name_with_NaN) == 0:
-                    self.input_df['商品コード'] = self.input_df['商品コード'].astype(int)
-                    self.input_df['現在庫'] = self.input_df['現在庫'].astype(int)
-                    self.input_df['発注数'] = self.input_df['発注数'].astype(int)
-                    self.input_df['セット'] = self.input_df['セット'].astype(int)
-
-                # 非食品
-                if values_nonfood is not None:
-                    max_columns_nonfood = len(values_nonfood[0])
-                    data_nonfood = [row + [None] * (max_columns_nonfood - len(row)) for row in values_nonfood[1:]]
-                    df_nonfood = pd.DataFrame(data_nonfood, columns=values_nonfood[0])
-                    self.input_df_nonfood = df_nonfood[['商品名', '商品コード', '発注数']]
-                    self.input_df_nonfood['発注数'] = self.input_df_nonfood['発注数'].astype(str).str.strip()
-                    self.input_df_nonfood['発注数'] = pd.to_numeric(self.input_df_nonfood['発注数'], errors='coerce')
-                    self.input_df_nonfood.dropna(subset=['発注数'], inplace=True)
-                    self.input_df_nonfood = self.input_df_nonfood[self.input_df_nonfood['発注数'] != 0]
-                    if not self.input_df_nonfood.empty:
-                        self.input_df_nonfood.reset_index(drop=True, inplace=True)
-                        self.input_df_nonfood.replace('', None, inplace=True)
-                        self.input_df_nonfood['商品コード'] = self.input_df_nonfood['商品コード'].astype(int)
-                        self.input_df_nonfood['発注数'] = self.input_df_nonfood['発注数'].astype(int)
-                else:#非食品のシートがない場合
-                    self.input_df_nonfood = False
-                    
-                return Name_with_NaN, self.input_df_nonfood
-            
+        self.sheet_values[sheet_id] = {'revision': response.get('revision'), 'values_food': values_food, 'values_nonfood': values_nonfood}
+        return values_food, values_nonfood
+
+    @traced()
+    def get_spreadsheet(self, sheet_id):
+        values_food, values_nonfood = self.fetch_sheet_values(sheet_id)
+        return self.load_order_sheet(values_food, values_nonfood)
+
+    def load_order_sheet(self, values_food, values_nonfood):
+        import pandas as pd
+        from order_data import normalize_food, normalize_nonfood, OrderPlan
+        # 指定した複数の列をDataFrameに変換
+        if not values_food:
+            print('No data found in the sheet.')
+            return False, False
+        #食品
+        self.input_df, Name_with_NaN = normalize_food(values_food)
+        # 非食品
+        if values_nonfood is not None:
+            self.input_df_nonfood = normalize_nonfood(values_nonfood)
+        else:#非食品のシートがない場合
+            self.input_df_nonfood = False
+        # EOSに入力する内容（EOSの商品一覧との照合はinput_order_in_siteで行う）
+        self.order_plans = [OrderPlan(self.input_df, 'food')]
+        if isinstance(self.input_df_nonfood, pd.DataFrame) and not self.input_df_nonfood.empty:
+            self.order_plans.append(OrderPlan(self.input_df_nonfood, 'nonfood'))
+        return Name_with_NaN, self.input_df_nonfood
+
+    @traced()
     def input_order_in_site(self):
-        login_status_code = self.login_eos(st['EOS_ID'], st['EOS_PW'])
+        login_status_code = self.ensure_eos_session(self.st['EOS_ID'], self.st['EOS_PW'])
         logging.info(f'login_status_code(input_order_in_site): {login_status_code}')
         if login_status_code != "200":
             return False, login_status_code
@@ -413,108 +1077,116 @@ class AutomationHandler:
             logging.info('Dialog found')
         except TimeoutException:
             logging.info('No dialog found')
-        while len(self.driver.find_elements(By.XPATH, value="//button[@title='Close']"))>0 :
-            self.driver.find_element(By.XPATH, value="//button[@title='Close']").click()
+        if self.close_dialogs() > 0:
             logging.info('Dialog closed')
-            time.sleep(0.05)
 
-        
-        if isinstance(self.input_df_nonfood, bool):
-            input_df_tuple = (self.input_df,)
-        elif isinstance(self.input_df_nonfood, pd.DataFrame):
-            input_df_tuple = (self.input_df, self.input_df_nonfood)
-        else:
-            input_df_tuple = (self.input_df,)
-            logging.warning('input_df_nonfood is neither bool nor DataFrame')
 
         error_ls = [] #入力エラーの空リストを作成
-        for df in input_df_tuple:
-            if df is self.input_df:
-                print(f'df is self.input')
-            elif df.shape[0] == 0:
-                print(f'df is False')
-                continue
-            else:
-                print(f'df is nonfood')
+        for plan in self.order_plans:
+            if plan.kind == 'nonfood':
                 WebDriverWait(self.driver, 10).until(EC.presence_of_element_located((By.CLASS_NAME, 'pushDay2')))
                 self.driver.find_elements(By.CLASS_NAME, 'pushDay2')[0].click()
 
-            # 発注サイトの商品番号をリストにする
+            # 発注サイトの商品一覧を1回の呼び出しで取得し、入力内容を確定
             WebDriverWait(self.driver, 10).until(EC.presence_of_all_elements_located((By.CLASS_NAME, 'scode')))
-            table_number_ls = self.driver.find_elements(By.CLASS_NAME, 'scode') #ドライバーのリストができる
-            for i in range(len(table_number_ls)):
-                table_number_ls[i] = int(table_number_ls[i].text) #ドライバーのリストを商品番号のリストに変換
-
-            # 発注サイトの商品名をリストにする
-            table_name_ls = self.driver.find_elements(By.XPATH, value="//span[starts-with(@id, 'syhnnm')]" ) #ドライバーのリストができる
-            for i in range(len(table_name_ls)):
-                table_name_ls[i] = str(table_name_ls[i].text) #ドライバーのリストを商品名のリストに変換
-
-            # 発注サイトのprdxをリストにする
-            table_prdx_ls = self.driver.find_elements(By.XPATH, value="//input[starts-with(@id, 'prdx')]") #ドライバーのリストができる
-            for i in range(len(table_prdx_ls)):
-                table_prdx_ls[i] = str(table_prdx_ls[i].get_attribute("id"))
-
-            # 商品番号リストとprdxリストから辞書を作成
-            table_prdx_number_dict = dict(zip(table_number_ls, table_prdx_ls))
-
-            dict_data = pd.Series(df['商品名'].values, index=df['商品コード'].values) #商品名：商品コードの辞書作成
+            plan.compile(self.snapshot_order_table())
+            self.log_order_plan(plan)
+            error_ls.extend(plan.errors)
+            if self.st.get('ORDER_DRY_RUN', 'False') == 'True': # 入力せずに入力内容の確認のみ
+                continue
 
             # 入力
-            for row in df.itertuples():
-                if row.発注数 <= 0:
+            if self.st.get('BULK_INPUT', 'True') == 'True':
+                try:
+                    self.input_orders_bulk(plan, error_ls)
                     continue
-                else:
-                    try:
-                        table_id = table_prdx_number_dict[row.商品コード] #発注する商品番号から商品のprdx値を求める
-                    except:
-                        error_ls.append(f"{row.商品コード}：{dict_data[row.商品コード]}（エラー理由：EOSに存在しない商品, 商品番号の誤り, お気に入り未登録）")
-                        continue
-                    set_value = int(self.driver.find_element(By.ID, table_id).get_attribute('data-sthtsu')) #セット数（EOS由来）
-                    order_value = set_value * row.発注数 #発注入力数
-                    print(f'{row.商品名}:{order_value}')
-
-                    if  df is self.input_df:
-                        if not set_value == row.セット: #発注書とEOSのセット数が一致しているか確認
-                            print(f"商品番号：{row.商品コード}のセット数が誤っています。発注書のセット数を修正してください。")
-                    else:
-                        pass
-                        
-                    try:
-                        input_field = WebDriverWait(self.driver, 10).until(EC.presence_of_element_located((By.ID, table_id)))
-                        input_field.clear() #input_fieldのデフォルト0をクリア   
-                        input_field.send_keys(order_value) #発注数を入力
-                    except: 
-                        dialog_text = self.driver.find_element(By.ID, 'divDialog').text
-                        if '制限数量' in dialog_text:
-                            error_ls.append(f'{former_input_number}：{dict_data[former_input_number]}（エラー理由：発注数MAX超え）')
-                            self.driver.find_element(By.CLASS_NAME, 'ui-icon-closethick').click() # ×ボタンでダイアログを閉じる
-                            input_field = WebDriverWait(self.driver, 10).until(EC.presence_of_element_located((By.ID, former_table_id)))
-                            input_field.clear()
-
-                            #former_max_order_valueがsetvalueで割り切れない場合があるので、setvalueを足していき、former_max_order_valueを超えないさいだいのsetvalueの倍数にする
-                            former_max_order_value = int(self.driver.find_element(By.ID, former_table_id).get_attribute('data-sgosuu')) - 1
-                            former_max_input = (former_max_order_value // former_set_value) * former_set_value
-
-                            print(f'商品名：{dict_data[former_input_number]} 発注数MAX超え：{former_max_order_value}→{former_max_input}')
-                            input_field.send_keys(former_max_input) #発注数を入力
-                        else:
-                            error_ls.append(f'{former_input_number}：{dict_data[former_input_number]}（エラー理由：不明）')
-                            self.driver.find_element(By.CLASS_NAME, 'ui-icon-closethick').click() # ×ボタンでダイアログを閉じる
-                        
-                        input_field = WebDriverWait(self.driver, 10).until(EC.presence_of_element_located((By.ID, table_id)))
-                        input_field.clear() #input_fieldのデフォルト0をクリア   
-                        input_field.send_keys(order_value) #発注数を入力
-                former_set_value = set_value
-                former_table_id = table_prdx_number_dict[row.商品コード]
-                former_input_number = row.商品コード  
+                except Exception as e:
+                    logging.warning(f'一括入力に失敗したため1行ずつ入力します: {e}')
+            self.input_orders_row_by_row(plan, error_ls)
 
         if len(error_ls) > 0 :    
             for i in range(len(error_ls)):
                 print(f'\033[93m{error_ls[i]}\033[0m')
         return True, error_ls
 
+    def log_order_plan(self, plan):
+        # 入力内容・前回の入力からの変更・セット数の不一致をログに記録
+        for entry in plan.records():
+            print(f"{entry['商品名']}:{entry['入力数']}")
+        for code in plan.set_mismatches:
+            print(f"商品番号：{code}のセット数が誤っています。発注書のセット数を修正してください。")
+        for entry in plan.entries[plan.entries['MAX超え']].itertuples():
+            print(f"商品名：{entry.商品名} 発注数MAX超え：{entry.発注数量}→{entry.入力数}")
+        changes = plan.diff(self.last_order_plans.get(plan.kind))
+        if plan.kind in self.last_order_plans and changes:
+            logging.info(f'前回の入力からの変更({plan.kind}): {changes}')
+        self.last_order_plans[plan.kind] = plan
+        logging.info(f'入力内容({plan.kind}): {json.dumps(plan.records(), ensure_ascii=False, default=str)}')
+
+    def snapshot_order_table(self):
+        # 発注入力画面の商品一覧（商品番号, 商品名, prdx, セット数, 制限数量）を取得
+        table_rows = self.driver.execute_script(ORDER_TABLE_SCRIPT)
+        logging.info(f'発注画面の商品数: {len(table_rows)}')
+        return table_rows
+
+    def input_orders_bulk(self, plan, error_ls):
+        # 発注数をJavaScriptで一括入力（WebDriverの呼び出しは1回）
+        # 制限数量はplanで反映済みなので、'max'はEOSの制限数量が商品一覧の取得後に変わった場合のみ
+        results = self.driver.execute_script(BULK_INPUT_SCRIPT, plan.vector())
+        input_numbers = dict(zip(plan.entries['prdx'], plan.entries['商品コード']))
+        for result in results:
+            input_number = input_numbers[result['id']]
+            if result['status'] == 'max':
+                error_ls.append(f'{input_number}：{plan.names[input_number]}（エラー理由：発注数MAX超え）')
+                print(f"商品名：{plan.names[input_number]} 発注数MAX超え：{result['max']}→{result['value']}")
+            elif result['status'] != 'ok':
+                error_ls.append(f'{input_number}：{plan.names[input_number]}（エラー理由：不明）')
+                logging.warning(f'一括入力エラー: {result}')
+        logging.info(f'一括入力完了: {len(results)}件')
+
+    def input_orders_row_by_row(self, plan, error_ls):
+        # 発注数を1行ずつ入力（一括入力が使えない場合のフォールバック）
+        dict_data = plan.names
+        for table_id, input_number, set_value, order_value, limit in plan.orders():
+            try:
+                input_field = WebDriverWait(self.driver, 10).until(EC.presence_of_element_located((By.ID, table_id)))
+                input_field.clear() #input_fieldのデフォルト0をクリア   
+                input_field.send_keys(order_value) #発注数を入力
+            except: 
+                dialog_text = self.driver.find_element(By.ID, 'divDialog').text
+                if '制限数量' in dialog_text:
+                    error_ls.append(f'{former_input_number}：{dict_data[former_input_number]}（エラー理由：発注数MAX超え）')
+                    self.driver.find_element(By.CLASS_NAME, 'ui-icon-closethick').click() # ×ボタンでダイアログを閉じる
+                    input_field = WebDriverWait(self.driver, 10).until(EC.presence_of_element_located((By.ID, former_table_id)))
+                    input_field.clear()
+
+                    if former_limit is None: # 商品一覧の取得時に制限数量がなかった場合は、画面の制限数量を使う（一括入力と同じ）
+                        limit_attribute = input_field.get_attribute('data-sgosuu')
+                        former_limit = int(limit_attribute) if limit_attribute and limit_attribute.strip().isdigit() else None
+                    if former_limit:
+                        #former_max_order_valueがsetvalueで割り切れない場合があるので、setvalueを足していき、former_max_order_valueを超えないさいだいのsetvalueの倍数にする
+                        former_max_order_value = former_limit - 1
+                        former_max_input = (former_max_order_value // former_set_value) * former_set_value
+
+                        print(f'商品名：{dict_data[former_input_number]} 発注数MAX超え：{former_max_order_value}→{former_max_input}')
+                        input_field.send_keys(former_max_input) #発注数を入力
+                    else:
+                        logging.warning(f'制限数量が取得できないため入力しません: {former_input_number}')
+                else:
+                    error_ls.append(f'{former_input_number}：{dict_data[former_input_number]}（エラー理由：不明）')
+                    self.driver.find_element(By.CLASS_NAME, 'ui-icon-closethick').click() # ×ボタンでダイアログを閉じる
+                
+                input_field = WebDriverWait(self.driver, 10).until(EC.presence_of_element_located((By.ID, table_id)))
+                input_field.clear() #input_fieldのデフォルト0をクリア   
+                input_field.send_keys(order_value) #発注数を入力
+            former_set_value = set_value
+            former_table_id = table_id
+            former_input_number = input_number
+            former_limit = limit
+
     def destroy_chrome(self):
+        if self.timeline.profiler.total > 0: # WebDriverの呼び出しの多い箇所をログに記録
+            logging.info(self.timeline.profiler.summary())
         try:
             self.driver.close()
             self.driver.quit()
@@ -14,13 +14,9 @@ import http.client
 import urllib.parse
 import configparser
 import webbrowser
-from freezegun import freeze_time
-import qrcode
-from PIL import ImageTk
 import traceback
 import subprocess
 import time
-import winreg as reg
 
 def resource_path(relative_path):
     try:
@@ -92,10 +88,15 @@ if getattr(sys, 'frozen', False):
 else:
     file_version = "3.7.1.1"
 
-from Automation import AutomationHandler
+from Automation import AutomationHandler, GasCallCancelled, gas_latency_summary, warm_up
+from pipeline import OrderPipeline
+from async_client import AsyncAutomationClient, BackgroundLoop
+from tracing import timeline_path
+from platform_paths import chrome_path
 
 # Error handling ---------------------------------------------------
 error_occurred = False
+error_log_handler = None # エラーログのアップロードに使うAutomationHandler（最初のエラーで作成し、以降は再利用する）
 
 def send_line_notify(message):
     conn = http.client.HTTPSConnection("notify-api.line.me")
@@ -113,6 +114,7 @@ def handle_exception(exc, message=False):
     print(exc)
     logging.exception(exc)
     global error_occurred
+    global error_log_handler
     global log_file
     error_occurred = True   
     error_message = traceback.format_exc()
@@ -126,6 +128,7 @@ def handle_exception(exc, message=False):
 
     # GASでエラーログをアップロード
     try:
+        logging.info(f"GAS latency: {gas_latency_summary()}")
         current_time = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
         log_filename = f"error_log_{st['SHOP_NAME']}{current_time}.txt"
         with open(log_file, 'r', encoding='utf-8') as file:
@@ -134,8 +137,10 @@ def handle_exception(exc, message=False):
             'filename': log_filename,
             'content': content
         }
-        handler = AutomationHandler()
-        response = handler.call_google_script('saveLogTxt', params)
+        # 画面のhandlerは使わない（中止した後のcancel_eventや再試行の表示の影響を受けないように）
+        if error_log_handler is None:
+            error_log_handler = AutomationHandler()
+        response = error_log_handler.call_google_script('saveLogTxt', params)
         if response['success']:
             logging.info(f"Error log uploaded successfully")
         else:
@@ -151,6 +156,8 @@ def handle_exception(exc, message=False):
 def thread_with_error_handle(target, *args, **kwargs):
     try:
         target(*args, **kwargs)
+    except GasCallCancelled as e: # ユーザーが中止した場合はエラーとして扱わない
+        logging.info(e)
     except Exception as e:
         handle_exception(e)
 
@@ -164,6 +171,7 @@ class MainApplication(tk.Tk):
         contact_button = tk.Button(frame, text="ヘルプ", cursor="hand2", command=self.show_qr)
         contact_button.place(relx=1.0, rely=1.0, anchor='se', x=-10, y=-10)
         frame.tkraise()
+        self.current_frame = frame
 
     def show_qr(self):
         qr_window = tk.Toplevel()
@@ -210,13 +218,35 @@ class MainApplication(tk.Tk):
                 os.remove(os.path.join(self.handler.download_folder_path(), f'{self.today_str_csv}_発注_filtered.CSV'))
 
     def check_internet(self):
+        return self.loop.run(self.async_client.check_internet())
+
+    def apply_prefetched(self, future):
+        # prefetch_startupの結果を反映する（メインスレッドで呼ばれる）
+        # 既に最初の画面から進んでいる場合は、お知らせ以外（画面の切り替え・作成済みの発注書）は使わない
         try:
-            conn = http.client.HTTPSConnection("www.google.com", timeout=5)
-            conn.request("HEAD", "/")
-            conn.close()
-            return True # インターネット接続がある
+            prefetched = future.result()
         except Exception as e:
-            return False # インターネット接続がない
+            logging.warning(f"起動時の先読みに失敗しました: {e}")
+            return
+        on_first_page = isinstance(self.current_frame, Page_1)
+        if 'notices' in prefetched:
+            self.notice_list = prefetched['notices']
+            if on_first_page:
+                self.current_frame.show_notices(self.notice_list)
+        if not on_first_page:
+            return
+        if 'existing_sheet' in prefetched:
+            self.prefetched.update(existing_sheet=prefetched['existing_sheet'], existing_sheet_at=prefetched['existing_sheet_at'])
+        # アップデートチェック
+        need_update, self.latest_version = prefetched['update']
+        if need_update:
+            self.show_frame(Page_Update)
+        elif self.latest_version == 404:
+            # インターネットが接続されているか確認
+            if not self.check_internet():
+                messagebox.showerror("インターネット接続不良", "インターネットが接続されていない可能性があります。\nインターネット接続を確認して起動し直してください。")
+                self.destroy()  # OKをクリックしたらウィンドウを閉じる
+                self.quit()
     
     def __init__(self):
         super().__init__()
@@ -238,24 +268,18 @@ class MainApplication(tk.Tk):
         self.today_int = None
 
         self.handler = AutomationHandler()
+        self.handler.timeline.path = timeline_path(log_file) # 段階ごとの処理時間をログと同じフォルダに保存
+        # 通信はバックグラウンドの1つのイベントループでまとめて実行する（画面ごとにスレッドを作らない）
+        self.loop = BackgroundLoop()
+        self.async_client = AsyncAutomationClient(self.handler)
 
         if st['comp'] == "True":
-            # アップデートチェック
-            need_update, self.latest_version = self.handler.check_update(st['SHOP_NAME'], file_version)
-            if need_update:
-                self.show_frame(Page_Update)
-            elif self.latest_version == 404:
-                # インターネットが接続されているか確認
-                if not self.check_internet():
-                    messagebox.showerror("インターネット接続不良", "インターネットが接続されていない可能性があります。\nインターネット接続を確認して起動し直してください。")
-                    self.destroy()  # OKをクリックしたらウィンドウを閉じる
-                    self.quit()
-                else:
-                    self.protocol("WM_DELETE_WINDOW", self.on_close)
-                    self.show_frame(Page_1)
-            else:
-                self.protocol("WM_DELETE_WINDOW", self.on_close)
-                self.show_frame(Page_1)
+            # 最初の画面を表示してから、アップデート・お知らせ・作成済みの発注書をバックグラウンドでまとめて取得
+            self.prefetched = {}
+            self.protocol("WM_DELETE_WINDOW", self.on_close)
+            self.show_frame(Page_1)
+            self.loop.submit(self.async_client.prefetch_startup(file_version, self.today_int, f"発注書_{self.today_str}"),
+                             self.apply_prefetched, widget=self)
         else:
             self.protocol("WM_DELETE_WINDOW", self.on_close)
             self.show_frame(Page_0)        
@@ -288,6 +312,40 @@ class Progress_Page(tk.Frame):
         self.progress = ttk.Progressbar(self, orient="horizontal", mode="indeterminate")
         self.progress.pack(pady=30)
         self.progress.start(10)
+        self.cancel_button = None
+        self.cancelled = False
+        # 新しい処理の開始（前の画面で中止した場合も、この画面のGAS呼び出しは中止しない）
+        parent.handler.cancel_event.clear()
+        parent.handler.gas_progress = None
+
+    def show_retry_progress(self, parent):
+        # GAS呼び出しを再試行している間は、再試行の回数と中止ボタンを表示する
+        # progressはGASを呼び出したスレッドで呼ばれるので、画面の更新はメインスレッドで行う
+        text = self.label_p.cget("text")
+        def show_retry(attempt, max_attempts):
+            if self.cancelled:
+                return
+            self.label_p.config(text=f"{text}\n通信を再試行しています（{attempt}/{max_attempts}回目）")
+            if self.cancel_button is None:
+                self.cancel_button = tk.Button(self, text="中止", cursor="hand2", command=lambda: self.cancel(parent))
+                self.cancel_button.pack()
+        def progress(function_name, attempt, max_attempts):
+            if attempt > 1:
+                self.after(0, show_retry, attempt, max_attempts)
+        parent.handler.gas_progress = progress
+
+    def show_next(self, parent, cont):
+        # 処理中のスレッドから次の画面に進む（中止した後は、新しく始めた処理の画面を切り替えない）
+        if self.cancelled:
+            return
+        parent.handler.gas_progress = None
+        parent.show_frame(cont)
+
+    def cancel(self, parent):
+        self.cancelled = True
+        parent.handler.cancel_event.set() # 次の画面（Progress_Page）を開くまでGAS呼び出しを中止する
+        parent.handler.gas_progress = None
+        parent.show_frame(Page_1)
 
 class List_Page(tk.Frame):
     def __init__(self, parent):
@@ -364,6 +422,7 @@ class Page_Update(Progress_Page):
     def __init__(self, parent):
         super().__init__(parent)
         self.label_p.config(text="アップデートを準備中…")
+        self.download_percent = None # 最後に表示したダウンロードの進捗（%）
         threading.Thread(target=self.ask_update, args=(parent,), daemon=True).start()
         
     def ask_update(self, parent):
@@ -371,7 +430,8 @@ class Page_Update(Progress_Page):
             if messagebox.askyesno("アップデートの確認", "新しいバージョンがあります。今すぐアップデートしますか？\nアップデートには2～3分かかる場合があります。"):
                 logging.info("ユーザーがアップデートを承認しました。") 
                 installer_path = f"setup/KAOS_setup.{parent.latest_version}.exe"
-                download_success = parent.handler.download_updater(parent.latest_version, installer_path)
+                self.label_p.config(text="アップデートをダウンロードしています…")
+                download_success = parent.handler.download_updater(parent.latest_version, installer_path, self.show_download_progress)
                 self.progress.stop()
                 if download_success:
                     # インストーラの実行
@@ -391,6 +451,23 @@ class Page_Update(Progress_Page):
         except Exception as e:
             handle_exception(e)
 
+    def show_download_progress(self, downloaded, total):
+        # ダウンロードの進捗をプログレスバーに表示（サイズが分からない場合は従来の表示のまま）
+        # ダウンロード中のスレッドから呼ばれるので、表示が変わる場合（1%ごと）だけメインスレッドで更新する
+        if not total:
+            return
+        percent = downloaded * 100 // total
+        if percent != self.download_percent:
+            self.download_percent = percent
+            self.after(0, self.update_download_progress, percent)
+
+    def update_download_progress(self, percent):
+        if self.progress['mode'] != 'determinate':
+            self.progress.stop()
+            self.progress.config(mode='determinate', maximum=100)
+        self.progress.config(value=percent)
+        self.label_p.config(text=f"アップデートをダウンロードしています…{percent}%")
+
 
 class Page_0(tk.Frame):
     def __init__(self, parent):
@@ -446,13 +523,16 @@ class Page_0(tk.Frame):
         if shop_name and eos_user_id and eos_password:
             if messagebox.askokcancel("設定の保存","現在の入力で設定を保存しますか？", detail="保存するとアプリが再起動します。"):
                 timestamp = datetime.now()
+                # 画面で編集しない設定項目（BULK_INPUTなど）はそのまま引き継ぐ
+                # configparserはキーを小文字で返すので、既存の項目（SHOP_NAMEなど）と同じく大文字で書き込む
+                extra_settings = "".join(f"{key.upper()} = {value}\n" for key, value in st.items() if key not in ('comp', 'shop_name', 'eos_id', 'eos_pw'))
                 file_content = f""";{timestamp}
 [Settings]
 comp = True
 SHOP_NAME = {shop_name}
 EOS_ID = {eos_user_id}
 EOS_PW = {eos_password}
-        """        
+{extra_settings}"""
                 file_name = r"setup/config.ini"
                 # ファイルを作成して内容を書き込みます
                 if os.path.exists(file_name):
@@ -475,6 +555,7 @@ class Page_1(Text_and_Button_Page):
         # 前日の日付を取得 as YYYY-MM-DD
         yesterday_int = parent.today_int - timedelta(days=1)
         parent.yesterday_str = yesterday_int.strftime('%Y-%m-%d') 
+        parent.pipeline = OrderPipeline(parent.handler, parent.today_int) # 発注処理の流れ（GUIに依存しない部分）
 
         #設定ボタン
         setting_icon = tk.PhotoImage(file=resource_path('setup/setting_icon.png')).subsample(2,2)
@@ -490,23 +571,9 @@ class Page_1(Text_and_Button_Page):
         sheet_button.place(relx=0, rely=0, anchor='nw', x=41, y=10)
         sheet_button_tooltip = ToolTip(sheet_button, "発注書[原本]を編集") 
 
-        #お知らせ
+        #お知らせ（起動直後は取得が終わってからMainApplication.apply_prefetchedで表示する）
         if hasattr(parent, 'notice_list'):
-            notice_list = parent.notice_list
-        else:
-            notice_list = parent.handler.get_notices(file_version, parent.today_int)
-            parent.notice_list = notice_list
-
-        if notice_list:
-            notice_frame = tk.Frame(self, relief=tk.GROOVE, bd=2)
-            notice_frame.pack(before=self.button1, pady=(0, 25))
-            notice_title = tk.Label(notice_frame, text="お知らせ")
-            notice_title.pack(anchor='w')
-            notice_box = tk.Text(notice_frame, width=48, height=4.5, relief=tk.FLAT, font=("Yu Gothic UI", 10))
-            for notice in notice_list:
-                notice_box.insert(tk.END, f"{notice}\n")
-            notice_box.pack()
-            notice_box.config(state=tk.DISABLED)
+            self.show_notices(parent.notice_list)
 
         parent.attributes("-topmost", True)
         parent.attributes("-topmost", False)
@@ -526,6 +593,19 @@ class Page_1(Text_and_Button_Page):
             parent.today_str_csv = parent.today_real_int.strftime('%Y%m%d')
         self.bind_all('<Control-t>', lambda e: self.place_entry(parent)) #開発用、任意の時刻を設定するコマンド
 
+    def show_notices(self, notice_list):
+        if not notice_list:
+            return
+        notice_frame = tk.Frame(self, relief=tk.GROOVE, bd=2)
+        notice_frame.pack(before=self.button1, pady=(0, 25))
+        notice_title = tk.Label(notice_frame, text="お知らせ")
+        notice_title.pack(anchor='w')
+        notice_box = tk.Text(notice_frame, width=48, height=4.5, relief=tk.FLAT, font=("Yu Gothic UI", 10))
+        for notice in notice_list:
+            notice_box.insert(tk.END, f"{notice}\n")
+        notice_box.pack()
+        notice_box.config(state=tk.DISABLED)
+
     def place_entry(self,parent):
         self.label1.config(text="日時を 'YYYY-MM-DD HH:MM:SS' 形式で入力してください")
         self.button1.forget()
@@ -537,6 +617,7 @@ class Page_1(Text_and_Button_Page):
     def datetime_setting(self, parent):
         input_date = self.datetime_entry.get()
         dt = datetime.strptime(input_date, "%Y-%m-%d %H:%M:%S")
+        from freezegun import freeze_time # 開発用の画面でのみ使う
         with freeze_time(dt):
             # 固定された現在時刻を表示
             logging.info("固定された現在時刻: ", datetime.now())
@@ -552,22 +633,17 @@ class Page_OS(Progress_Page):
         self.start_open_original_sheet(parent)
 
     def start_open_original_sheet(self, parent):
-        threading.Thread(target=thread_with_error_handle, args=(self.open_original_sheet, parent,),daemon=True).start()
+        parent.loop.submit(parent.async_client.get_original_sheet(), lambda future: self.open_original_sheet(parent, future), widget=self)
 
     def get_chrome_path(self):
         try:
-            # レジストリキーのパス
-            reg_path = r"SOFTWARE\Microsoft\Windows\CurrentVersion\App Paths\chrome.exe"
-            reg_key = reg.OpenKey(reg.HKEY_LOCAL_MACHINE, reg_path)
-            chrome_path, _ = reg.QueryValueEx(reg_key, "")
-            reg.CloseKey(reg_key)
-            return chrome_path
+            return chrome_path()
         except Exception as e:
             return None
 
-    def open_original_sheet(self, parent):
+    def open_original_sheet(self, parent, future):
         try:
-            original_sheet_url = parent.handler.get_original_sheet()
+            original_sheet_url = future.result()
             if original_sheet_url == False:
                 raise Exception("Original sheet not found")
             else:
@@ -596,16 +672,21 @@ class Page_2i(Progress_Page): # 既存の発注書の存在確認
         self.after(0, self.start_check_form(parent))
 
     def start_check_form(self, parent):
-        threading.Thread(target=thread_with_error_handle, args=(self.check_form, parent,),daemon=True).start()
-
-    def check_form(self, parent):
-        check_result = parent.handler.check_existing_sheet(parent.today_order_file)
-        if check_result == False:
-            parent.sheet_id, parent.sheet_url = False, False
-            parent.show_frame(Page_4)
+        sheet_name = parent.pipeline.sheet_name
+        prefetched_sheet = parent.async_client.take_existing_sheet(parent.prefetched, sheet_name) if hasattr(parent, 'prefetched') else None
+        if prefetched_sheet is not None: # 起動の直後（起動時に確認済み）
+            self.after(0, thread_with_error_handle, self.check_form, parent, prefetched_sheet)
         else:
-            parent.sheet_id, parent.sheet_url = check_result
+            parent.loop.submit(parent.async_client.check_existing_sheet(sheet_name),
+                               lambda future: thread_with_error_handle(lambda: self.check_form(parent, (sheet_name, future.result()))), widget=self)
+
+    def check_form(self, parent, check_result):
+        sheet_found = parent.pipeline.check(check_result)
+        parent.sheet_id, parent.sheet_url = parent.pipeline.sheet_id, parent.pipeline.sheet_url
+        if sheet_found:
             parent.show_frame(Page_3)
+        else:
+            parent.show_frame(Page_4)
 
 class Page_3(Text_and_2Buttons_Page): # すでに本日の発注書が存在する場合
     def __init__(self, parent):
@@ -620,25 +701,27 @@ class Page_4(Progress_Page): #発注書作成
     def __init__(self, parent):
         super().__init__(parent)
         self.label_p.config(text="本日の発注書を作成しています...")
+        self.show_retry_progress(parent)
         self.after(0, self.start_setup_form(parent))
 
     def start_setup_form(self, parent):
         threading.Thread(target=thread_with_error_handle, args=(self.setup_form, parent,),daemon=True).start()
 
     def setup_form(self, parent):
-        download_status = parent.handler.download_csv(parent.today_str_csv, parent.today_int)
+        download_status = parent.pipeline.download()
+        if self.cancelled: # ダウンロード中に中止された
+            return
         if download_status=="200":
-            generate_result = parent.handler.generate_form(parent.delivery_date_int, parent.today_str)
-            if generate_result == False:
+            if not parent.pipeline.generate():
                 raise Exception
             else:
-                parent.sheet_id, parent.sheet_url = generate_result
+                parent.sheet_id, parent.sheet_url = parent.pipeline.sheet_id, parent.pipeline.sheet_url
             self.progress.stop()
-            parent.show_frame(Page_6)            
+            self.show_next(parent, Page_6)
         elif download_status=="E0007":
             handle_exception(Exception("ユーザーまたはパスワードが不一致"), message="EOSのユーザーIDまたはパスワードが一致しませんでした。\nKAOSの最初の画面の⚙のアイコンから、ユーザーIDとパスワードを確認してください。")
         else:
-            parent.show_frame(Page_5)
+            self.show_next(parent, Page_5)
 
 class Page_5(Text_and_Button_Page): #発注明細ダウンロード失敗
     def __init__(self, parent):
@@ -674,7 +757,9 @@ class Page_6(Text_and_Button_Page): #発注書生成完了&入力確認
         self.button1.config(text="はい", command=lambda: parent.show_frame(Page_7))
 
     def make_qr(self, url):
-        # QRコードの生成
+        # QRコードの生成（qrcode・PILはこの画面でのみ使うので、ここで読み込む）
+        import qrcode
+        from PIL import ImageTk
         print(url)
         qr = qrcode.QRCode(
             version=1,
@@ -705,13 +790,16 @@ class Page_7(Progress_Page): #発注数取得・入力
     def __init__(self, parent):
         super().__init__(parent)
         self.label_p.config(text="発注書からデータを取得しています...")
+        self.show_retry_progress(parent)
         self.after(0, self.start_confirm_synch(parent))
         
     def start_confirm_synch(self, parent):
         threading.Thread(target=thread_with_error_handle, args=(self.confirm_googledive_sinch, parent,),daemon=True).start()
 
     def confirm_googledive_sinch(self, parent):
-        NaN_ls, df_nonfood = parent.handler.get_spreadsheet(parent.sheet_id) #戻り値は現在庫が入力されてない商品名のリストと非食品のdf          
+        NaN_ls, df_nonfood = parent.pipeline.fetch() #戻り値は現在庫が入力されてない商品名のリストと非食品のdf          
+        if self.cancelled: # 取得中に中止された
+            return
         if NaN_ls is False:
             self.progress.stop()
             self.progress.pack_forget()
@@ -724,35 +812,35 @@ class Page_7(Progress_Page): #発注数取得・入力
             if df_nonfood.shape[0] == 0 and parent.today_int.weekday() in {1, 3, 5} and parent.nonfood0_ok == False:
                 self.progress.stop()
                 self.progress.pack_forget()
-                parent.show_frame(Page_7ii)
+                self.show_next(parent, Page_7ii)
             else:
                 if not NaN_ls:
                     self.label_p.config(text="EOSへ発注数を入力中...")
                     parent.attributes("-topmost", True)
-                    input_order_success, parent.error_ls = parent.handler.input_order_in_site()
+                    input_order_success, parent.error_ls = parent.pipeline.input()
                     self.progress.stop()
                     if input_order_success: 
-                        parent.show_frame(Page_8)   
+                        self.show_next(parent, Page_8)   
                     elif parent.error_ls == "E0007":
                         handle_exception(Exception("ユーザーまたはパスワードが不一致"), message="EOSのユーザーIDまたはパスワードが一致しませんでした。\nKAOSの最初の画面の⚙のアイコンから、ユーザーIDとパスワードを確認してください。")   
                 else: 
                     parent.NaN_ls = NaN_ls
                     self.progress.stop()
-                    parent.show_frame(Page_7i)    
+                    self.show_next(parent, Page_7i)    
         else:
             if not NaN_ls:
                 self.label_p.config(text="EOSへ発注数を入力中...")
                 parent.attributes("-topmost", True)
-                input_order_success, parent.error_ls = parent.handler.input_order_in_site()
+                input_order_success, parent.error_ls = parent.pipeline.input()
                 self.progress.stop()
                 if input_order_success: 
-                    parent.show_frame(Page_8)   
+                    self.show_next(parent, Page_8)   
                 elif parent.error_ls == "E0007":
                     handle_exception(Exception("ユーザーまたはパスワードが不一致"), message="EOSのユーザーIDまたはパスワードが一致しませんでした。\nKAOSの最初の画面の⚙のアイコンから、ユーザーIDとパスワードを確認してください。")   
             else: 
                 parent.NaN_ls = NaN_ls
                 self.progress.stop()
-                parent.show_frame(Page_7i)
+                self.show_next(parent, Page_7i)
 
 class Page_7i(List_Page):
     def __init__(self, parent):
@@ -818,6 +906,8 @@ if __name__ == "__main__":
     
     try:
         app = MainApplication()
+        # 最初の画面を描画した後に、Selenium・pandasをバックグラウンドで読み込む（画面の表示を待たせない）
+        app.after(0, app.after_idle, lambda: threading.Thread(target=warm_up, daemon=True).start())
         app.mainloop()
     except Exception as e:
         handle_exception(e)
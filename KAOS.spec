@@ -9,6 +9,11 @@ a = Analysis(
     binaries=[],
     datas=[
         ('Automation.py', '.'), 
+        ('order_data.py', '.'),
+        ('pipeline.py', '.'),
+        ('async_client.py', '.'),
+        ('tracing.py', '.'),
+        ('platform_paths.py', '.'),
         ('setup/KAOS_icon.ico', 'setup'),
         ('setup/sheet_icon.png', 'setup'),
         ('setup/setting_icon.png', 'setup'),
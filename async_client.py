@@ -0,0 +1,180 @@
+# © 2024 Keita Iwasa
+# ネットワーク処理の非同期版（asyncio + httpx）
+# 1つのバックグラウンドのイベントループで実行し、独立した通信（アップデート確認・お知らせ・作成済みの発注書の確認など）を並行して行う
+# パラメータの作成やレスポンスの解釈はAutomationHandlerと共通
+# インストーラーのダウンロード（アップデート画面のスレッドで進捗を表示）とエラー通知（イベントループが止まっていても送る）は同期版のまま使う
+
+import asyncio
+import logging
+import threading
+import time
+
+from Automation import CACHE_TTL, STARTUP_POLICY, GasCallCancelled, GasRetry
+
+httpx = None # 最初の通信のときにイベントループのスレッドで読み込む（GUIの起動を待たせない）
+
+def load_httpx():
+    global httpx
+    if httpx is None:
+        import httpx
+
+class BackgroundLoop:
+    # バックグラウンドのスレッドで動くasyncioのイベントループ
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def submit(self, coro, callback=None, widget=None):
+        # coroutineをループで実行し、concurrent.futures.Futureを返す
+        # callback(future)はwidgetを指定するとTkのメインスレッドで呼ばれる
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        if callback is not None:
+            if widget is not None:
+                future.add_done_callback(lambda done: widget.after(0, callback, done))
+            else:
+                future.add_done_callback(callback)
+        return future
+
+    def run(self, coro, timeout=None):
+        # coroutineの完了を待って結果を返す（GUIの起動処理など、結果がないと先に進めない場合）
+        return self.submit(coro).result(timeout)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+class AsyncAutomationClient:
+    def __init__(self, handler):
+        self.handler = handler
+        self.client = None # イベントループの中で作成する
+
+    async def http_client(self):
+        # ループ内で共有するHTTPクライアント（接続プール・Keep-Alive）
+        if self.client is None:
+            load_httpx()
+            self.client = httpx.AsyncClient(follow_redirects=True, timeout=30,
+                                            limits=httpx.Limits(max_connections=8, max_keepalive_connections=8))
+        return self.client
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def check_update(self, store_name, current_version): # return need_update, latest_version
+        # キャッシュ・ETagによる再検証・取得失敗時の代わりの値はAutomationHandler.check_updateと共通（別スレッドで実行）
+        return await asyncio.to_thread(self.handler.check_update, store_name, current_version)
+
+    async def call_google_script(self, function_name, params, policy=None):
+        # 再試行の方針・中止（handler.cancel_event）・試行回数の通知（handler.gas_progress）はAutomationHandler.call_google_scriptと共通（GasRetry）
+        retry = GasRetry(self.handler, function_name, policy)
+        client = await self.http_client()
+        for attempt in retry.attempts():
+            start = time.monotonic()
+            try:
+                response = await client.post(self.handler.script_url, json={'function': function_name, 'parameters': params},
+                                             timeout=retry.timeout(start))
+                self.handler.timeline.record(f'gas:{function_name}', start, bytes=len(response.request.content) + len(response.content),
+                                             attempt=attempt + 1, status=str(response.status_code))
+                if retry.accept(attempt, start, response.status_code, response.text):
+                    return response.json()
+            except (httpx.HTTPError, ValueError) as e: # 通信エラー・タイムアウト・JSONでない応答
+                retry.failed(attempt, start, e)
+            delay = retry.next_delay(attempt)
+            if delay is None:
+                break
+            await asyncio.to_thread(retry.wait, delay) # 待ち時間中も中止できるように、cancel_eventを別スレッドで待つ
+        raise retry.give_up()
+
+    async def call_google_script_batch(self, calls, policy=None):
+        # AutomationHandler.call_google_script_batchの非同期版（batch非対応の場合は並行して呼び出す）
+        if self.handler.gas_batch_supported() is not False:
+            response = await self.call_google_script('batch', {
+                'calls': [{'name': name, 'function': function_name, 'parameters': params} for name, (function_name, params) in calls.items()]
+            }, policy)
+            if 'results' in response:
+                self.handler.set_gas_batch_supported(True)
+                return response['results']
+            logging.info(f"GASがbatchに対応していないため個別に呼び出します: {response}")
+            self.handler.set_gas_batch_supported(False)
+        responses = await asyncio.gather(*(self.call_google_script(function_name, params, policy) for function_name, params in calls.values()))
+        return dict(zip(calls.keys(), responses))
+
+    async def cached_call(self, key, ttl, fetch):
+        # AutomationHandler.cached_callの非同期版（fetchはcoroutineを返す関数）
+        entry = self.handler.cache.fresh(key, ttl)
+        if entry:
+            return entry['value']
+        try:
+            return self.handler.store_cached(key, await fetch())
+        except GasCallCancelled:
+            raise
+        except Exception as e:
+            return self.handler.last_cached(key, e)
+
+    async def get_notices(self, version, today_int):
+        # AutomationHandler.get_noticesの非同期版（取得できない場合は最後に取得したお知らせ、なければFalse）
+        entry = self.handler.cache.fresh(self.handler.notices_key(version, today_int), CACHE_TTL['notices'])
+        if entry:
+            return self.handler.parse_notices(entry['value'])
+        try:
+            response = await self.call_google_script('getNotice', self.handler.notice_params(version, today_int))
+            return self.handler.parse_notices(self.handler.store_notices(version, today_int, response))
+        except GasCallCancelled:
+            raise
+        except Exception as e:
+            return self.handler.last_notices(version, e)
+
+    async def check_existing_sheet(self, sheet_name):
+        response = await self.call_google_script('checkExistingSheet', self.handler.existing_sheet_params(sheet_name))
+        return self.handler.parse_existing_sheet(response)
+
+    async def get_original_sheet(self):
+        shop_name = self.handler.st['SHOP_NAME']
+        response = await self.cached_call(f'original_sheet:{shop_name}', CACHE_TTL['original_sheet'],
+                                          lambda: self.call_google_script('getOriginalSheet', {'shopName': shop_name}))
+        return response['sheet_url'] if response['found'] else False
+
+    async def prefetch_startup(self, current_version, today_int, sheet_name):
+        # 最初の画面で必要な情報（アップデート・お知らせ・作成済みの発注書）をまとめて取得
+        # アップデート確認（サポートサーバー）とGASの呼び出しは並行して行う
+        # 戻り値: {'update': (need_update, latest_version), 'notices': ..., 'existing_sheet': (sheet_name, ...)}
+        # 取得に失敗した項目は含めない（各画面で個別に取得し直す）
+        async def fetch_gas():
+            notices_key = self.handler.notices_key(current_version, today_int)
+            calls = {'existing_sheet': ('checkExistingSheet', self.handler.existing_sheet_params(sheet_name))}
+            cached_notices = self.handler.cache.fresh(notices_key, CACHE_TTL['notices'])
+            if cached_notices is None:
+                calls['notices'] = ('getNotice', self.handler.notice_params(current_version, today_int))
+            prefetched = {}
+            try:
+                results = await self.call_google_script_batch(calls, STARTUP_POLICY)
+                prefetched['existing_sheet'] = (sheet_name, self.handler.parse_existing_sheet(results['existing_sheet']))
+                prefetched['existing_sheet_at'] = time.monotonic()
+            except Exception as e:
+                logging.warning(f"起動時の一括取得に失敗しました: {e}")
+                results = {}
+            prefetched.update(self.handler.prefetched_notices(current_version, today_int, cached_notices, results.get('notices')))
+            return prefetched
+        update, prefetched = await asyncio.gather(self.check_update(self.handler.st['SHOP_NAME'], current_version), fetch_gas())
+        prefetched['update'] = update
+        return prefetched
+
+    def take_existing_sheet(self, prefetched, sheet_name):
+        # prefetch_startupで確認した作成済みの発注書（発注書名, check_existing_sheetの戻り値）を1回だけ使う
+        # 発注書名が異なる場合・CACHE_TTL['existing_sheet']秒より前に確認した場合はNone（確認し直す）
+        existing_sheet = prefetched.pop('existing_sheet', None)
+        fetched_at = prefetched.pop('existing_sheet_at', None)
+        if existing_sheet is None or existing_sheet[0] != sheet_name or fetched_at is None:
+            return None
+        if time.monotonic() - fetched_at > CACHE_TTL['existing_sheet']:
+            return None
+        return existing_sheet
+
+    async def check_internet(self):
+        try:
+            client = await self.http_client()
+            await client.head("https://www.google.com", timeout=5)
+            return True # インターネット接続がある
+        except Exception:
+            return False # インターネット接続がない
@@ -0,0 +1,106 @@
+# © 2024 Keita Iwasa
+# 複数店舗の一括実行（GUIなし）
+# 実行方法: python batch_runner.py --stores setup/stores.ini --workers 4 --stage download,generate
+#
+# setup/stores.iniは1店舗につき1セクションで、config.iniのSettingsと同じ項目を書く。
+# [DEFAULT]に書いた項目は全店舗に適用される。
+#   [DEFAULT]
+#   DOWNLOAD_PROFILE = lean
+#   [店舗A]
+#   EOS_ID = ...
+#   EOS_PW = ...
+
+import argparse
+import configparser
+import json
+import logging
+import os
+import sys
+import time
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from Automation import AutomationHandler
+from pipeline import OrderPipeline
+from tracing import timeline_path
+
+def load_store_profiles(path):
+    # 店舗ごとの設定を読み込む（セクション名を店舗名とする）
+    config = configparser.ConfigParser()
+    with open(path, 'r', encoding='utf-8') as file:
+        config.read_file(file)
+    profiles = []
+    for section in config.sections():
+        profile = config[section]
+        if not profile.get('SHOP_NAME'):
+            profile['SHOP_NAME'] = section
+        # 店舗ごとにダウンロードフォルダを分けて、同じファイル名のCSVが衝突しないようにする
+        if not profile.get('DOWNLOAD_DIR'):
+            profile['DOWNLOAD_DIR'] = os.path.join('downloads', section)
+        profiles.append(profile)
+    return profiles
+
+def run_store(settings, stages, today_int=None, timeline_dir=None):
+    # 1店舗分の処理をstagesの順に実行し、結果を返す
+    # timeline_dirを指定すると店舗ごとのタイムラインを保存する
+    result = {'shop_name': settings['SHOP_NAME'], 'success': True, 'stages': {}, 'error': None}
+    handler = AutomationHandler(settings)
+    if timeline_dir:
+        os.makedirs(timeline_dir, exist_ok=True)
+        handler.timeline.path = timeline_path(os.path.join(timeline_dir, f"batch_{settings['SHOP_NAME']}{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}"))
+    pipeline = OrderPipeline(handler, today_int)
+    try:
+        result['stages'] = pipeline.run(stages)
+    except Exception as e:
+        logging.exception(f"{settings['SHOP_NAME']}: {e}")
+        result['success'] = False
+        result['error'] = str(e)
+    finally:
+        handler.destroy_chrome()
+    if pipeline.sheet_url:
+        result['sheet_url'] = pipeline.sheet_url
+    if pipeline.error_ls:
+        result['order_errors'] = pipeline.error_ls
+    return result
+
+def run_batch(profiles, stages, max_workers=2, today_int=None, timeline_dir=None):
+    # 店舗ごとにAutomationHandler（ブラウザ1つ）を割り当て、最大max_workers店舗を同時に実行する
+    results = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(run_store, profile, stages, today_int, timeline_dir): profile['SHOP_NAME'] for profile in profiles}
+        for future in as_completed(futures):
+            result = future.result()
+            logging.info(f"{result['shop_name']}: {'OK' if result['success'] else 'NG'} {result['stages']} {result['error'] or ''}")
+            results.append(result)
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='複数店舗の発注処理を一括実行します。')
+    parser.add_argument('--stores', default='setup/stores.ini', help='店舗ごとの設定ファイル')
+    parser.add_argument('--stage', default='download,generate', help=f"実行する処理（カンマ区切り: {','.join(OrderPipeline.HEADLESS_STAGES)}）")
+    parser.add_argument('--workers', type=int, default=2, help='同時に処理する店舗数')
+    parser.add_argument('--report', help='結果をJSONで保存するファイル')
+    parser.add_argument('--timeline-dir', default='error_log', help='店舗ごとのタイムラインを保存するフォルダ')
+    args = parser.parse_args(argv)
+
+    stages = [stage.strip() for stage in args.stage.split(',') if stage.strip()]
+    unknown_stages = [stage for stage in stages if stage not in OrderPipeline.STAGES]
+    if unknown_stages:
+        parser.error(f"不明な処理: {', '.join(unknown_stages)}")
+    gui_only_stages = [stage for stage in stages if stage in OrderPipeline.GUI_ONLY_STAGES]
+    if gui_only_stages:
+        parser.error(f"GUIでのみ実行できる処理です（入力した発注数を確認する前にブラウザを閉じるため）: {', '.join(gui_only_stages)}")
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(threadName)s - %(message)s')
+    start = time.monotonic()
+    results = run_batch(load_store_profiles(args.stores), stages, max(1, args.workers), timeline_dir=args.timeline_dir)
+    for result in sorted(results, key=lambda result: result['shop_name']):
+        print(f"{'OK' if result['success'] else 'NG'}\t{result['shop_name']}\t{result['stages']}\t{result['error'] or ''}")
+    print(f"{len(results)}店舗 / 失敗{sum(not result['success'] for result in results)}店舗 / {time.monotonic() - start:.1f}秒")
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as file:
+            json.dump(results, file, ensure_ascii=False, indent=2)
+    return 0 if all(result['success'] for result in results) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,274 @@
+# © 2024 Keita Iwasa
+# オフラインのデータ処理のベンチマーク（ネットワーク・ブラウザ・Windowsは不要）
+# 実行方法: python benchmark.py
+#   各処理は同じ実行の中で従来の処理と比べ、従来の何倍速いか（従来の秒数 / 新しい秒数）を結果とする
+#   --save-baseline: 結果をbenchmark_baseline.jsonに保存
+#   以降の実行では保存した結果と比較し、従来に対する速さが1/threshold倍未満に落ちた項目があれば終了コード1
+#   比率で比べるので、基準値を保存したパソコンとCIのランナーの速さの違いには左右されない
+#   Automation.pyなどの読み込み時間（python -X importtime）も計測して表示する（重いモジュールを読み込んでいる場合は終了コード1）
+# pytest-benchmarkでの計測: python -m pytest tests/test_benchmarks.py --benchmark-only
+
+import argparse
+from datetime import datetime, timedelta
+import io
+import json
+import os
+import subprocess
+import sys
+import random
+import time
+import warnings
+
+import pandas as pd
+
+from order_data import read_eos_csv, filter_delivery_date, normalize_food, normalize_nonfood, OrderPlan
+
+DAYS_JP = ['月', '火', '水', '木', '金', '土', '日']
+
+def eos_date_str(date):
+    return date.strftime('%Y-%m-%d') + f'({DAYS_JP[date.weekday()]})'
+
+def make_eos_csv(rows, today=datetime(2024, 5, 1), seed=0):
+    # EOSの発注明細CSVを模した合成データ（納品予定日・納品日には空欄もある）
+    # 最後の日付を翌日（抽出する日）にして、空欄の行が最後の日付として扱われないことも確認できるようにする
+    rng = random.Random(seed)
+    dates = [eos_date_str(today + timedelta(days=offset)) for offset in range(-30, 2)]
+    lines = ['発注日,店舗名,商品コード,商品名,セット,発注数,単価,納品予定日,納品日']
+    for i in range(rows):
+        delivery = rng.choice(dates)
+        lines.append(f"{rng.choice(dates)},テスト店,{100000 + i % 3000},商品{i % 3000},{rng.choice([1, 6, 12])},{rng.randint(0, 20)},{rng.randint(50, 3000)},{rng.choice([delivery, delivery, ''])},{rng.choice([delivery, ''])}")
+    return '\n'.join(lines) + '\n'
+
+def legacy_filter(csv_text, next_day):
+    # 従来のdownload_csvの処理（型推定ありで全列を読み込み、曜日付きの文字列で比較）
+    df = pd.read_csv(io.StringIO(csv_text))
+    next_day_str = eos_date_str(next_day)
+    return df[(df['納品予定日'] == next_day_str) | (df['納品日'] == next_day_str)]
+
+def fast_filter(csv_text, next_day, engine='c'):
+    df = read_eos_csv(io.StringIO(csv_text), engine=engine)
+    return filter_delivery_date(df, next_day)
+
+def measure(func, *args, repeat=5):
+    # repeat回実行した中の最速値（秒）
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def check_csv_filter(csv_text, next_day):
+    # 抽出した行が同じであることを確認（納品日の列は従来の文字列に対して新はカテゴリ型）
+    pd.testing.assert_frame_equal(legacy_filter(csv_text, next_day), fast_filter(csv_text, next_day), check_dtype=False, check_categorical=False)
+
+def bench_csv_filter(rows=50000):
+    csv_text = make_eos_csv(rows)
+    next_day = datetime(2024, 5, 2)
+    check_csv_filter(csv_text, next_day)
+    legacy = measure(legacy_filter, csv_text, next_day)
+    fast = measure(fast_filter, csv_text, next_day)
+    print(f"CSVフィルタ {rows}行: 従来 {legacy * 1000:.1f}ms / 新 {fast * 1000:.1f}ms（{legacy / fast:.2f}倍）")
+    return legacy / fast
+
+def make_sheet_values(rows, seed=0):
+    # getSpreadsheetの戻り値（values_food, values_nonfood）を模した合成データ
+    rng = random.Random(seed)
+    values_food = [['区分', '商品名', 'セット', '商品コード', '現在庫', '発注数', '備考']]
+    for i in range(rows):
+        if i % 50 == 0: # 区切りの行
+            values_food.append([f'区分{i // 50}'])
+            continue
+        row = ['食品', f'商品{i}', rng.choice([1, 6, 12]), 100000 + i, rng.randint(0, 30), rng.randint(0, 5)]
+        if rng.random() < 0.5: # 備考なし（行末の空セルは省略される）
+            row.append('メモ')
+        values_food.append(row)
+    values_nonfood = [['商品名', '商品コード', '発注数']]
+    for i in range(rows // 10):
+        values_nonfood.append([f'資材{i}', 200000 + i, rng.choice(['', 0, 1, ' 2 '])])
+    return values_food, values_nonfood
+
+def legacy_normalize(values_food, values_nonfood):
+    # 従来のget_spreadsheetの処理
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        max_columns = len(values_food[0])
+        data = [row + [None] * (max_columns - len(row)) for row in values_food[1:]]
+        df_food = pd.DataFrame(data, columns=values_food[0])
+        input_df = df_food[['商品名', 'セット', '商品コード', '現在庫', '発注数']]
+        input_df.replace('', None, inplace=True)
+        input_df.dropna(subset=['商品コード'], inplace=True)
+        input_df['商品コード'] = input_df['商品コード'].astype(str).str.strip()
+        input_df['商品コード'] = pd.to_numeric(input_df['商品コード'], errors='coerce')
+        input_df.dropna(subset=['商品コード'], inplace=True)
+        Name_with_NaN = input_df[input_df['現在庫'].isna()]['商品名'].tolist()
+        if len(Name_with_NaN) == 0:
+            for column in ['商品コード', '現在庫', '発注数', 'セット']:
+                input_df[column] = input_df[column].astype(int)
+        max_columns_nonfood = len(values_nonfood[0])
+        data_nonfood = [row + [None] * (max_columns_nonfood - len(row)) for row in values_nonfood[1:]]
+        df_nonfood = pd.DataFrame(data_nonfood, columns=values_nonfood[0])
+        input_df_nonfood = df_nonfood[['商品名', '商品コード', '発注数']]
+        input_df_nonfood['発注数'] = input_df_nonfood['発注数'].astype(str).str.strip()
+        input_df_nonfood['発注数'] = pd.to_numeric(input_df_nonfood['発注数'], errors='coerce')
+        input_df_nonfood.dropna(subset=['発注数'], inplace=True)
+        input_df_nonfood = input_df_nonfood[input_df_nonfood['発注数'] != 0]
+        if not input_df_nonfood.empty:
+            input_df_nonfood.reset_index(drop=True, inplace=True)
+            input_df_nonfood['商品コード'] = input_df_nonfood['商品コード'].astype(int)
+            input_df_nonfood['発注数'] = input_df_nonfood['発注数'].astype(int)
+    return input_df, Name_with_NaN, input_df_nonfood
+
+def fast_normalize(values_food, values_nonfood):
+    input_df, Name_with_NaN = normalize_food(values_food)
+    return input_df, Name_with_NaN, normalize_nonfood(values_nonfood)
+
+def check_sheet_normalize(values_food, values_nonfood):
+    legacy_food, legacy_missing, legacy_nonfood = legacy_normalize(values_food, values_nonfood)
+    fast_food, fast_missing, fast_nonfood = fast_normalize(values_food, values_nonfood)
+    assert legacy_missing == fast_missing
+    # 値が同じであることを確認（型は従来のint64に対して新はInt64）
+    pd.testing.assert_frame_equal(legacy_food, fast_food, check_dtype=False)
+    pd.testing.assert_frame_equal(legacy_nonfood, fast_nonfood, check_dtype=False)
+
+def bench_sheet_normalize(rows=3000):
+    values_food, values_nonfood = make_sheet_values(rows)
+    check_sheet_normalize(values_food, values_nonfood)
+    legacy = measure(legacy_normalize, values_food, values_nonfood)
+    fast = measure(fast_normalize, values_food, values_nonfood)
+    print(f"発注書の変換 {rows}行: 従来 {legacy * 1000:.1f}ms / 新 {fast * 1000:.1f}ms（{legacy / fast:.2f}倍）")
+    return legacy / fast
+
+def make_order_table(input_df, seed=0):
+    # 発注入力画面の商品一覧（snapshot_order_tableの戻り値）を模した合成データ
+    # 発注書の商品の一部はEOSにない（お気に入り未登録）ものとし、一部に制限数量を設定する
+    rng = random.Random(seed)
+    table_rows = []
+    for i, (code, set_value) in enumerate(zip(input_df['商品コード'], input_df['セット'])):
+        if rng.random() < 0.02:
+            continue
+        table_rows.append({'code': int(code), 'name': '', 'prdx': f'prdx{i}', 'set': int(set_value), 'limit': rng.choice([0, 0, 0, 20, 50])})
+    return table_rows
+
+def legacy_plan(df, table_rows):
+    # 従来のinput_order_in_siteの照合・掛け算（1行ずつ）
+    table_row_dict = {table_row['code']: table_row for table_row in table_rows}
+    orders, error_ls = [], []
+    for row in df.itertuples():
+        if row.発注数 <= 0:
+            continue
+        if row.商品コード not in table_row_dict:
+            error_ls.append(row.商品コード)
+            continue
+        table_row = table_row_dict[row.商品コード]
+        orders.append((table_row['prdx'], row.商品コード, table_row['set'], table_row['set'] * row.発注数, table_row['limit']))
+    return orders, error_ls
+
+def fast_plan(df, table_rows):
+    return OrderPlan(df).compile(table_rows)
+
+def check_order_plan(input_df, table_rows):
+    # 照合結果・セット数・掛け算の結果が従来と同じであることを確認（制限数量による調整は従来は入力時に行っていた）
+    orders, error_codes = legacy_plan(input_df, table_rows)
+    plan = fast_plan(input_df, table_rows)
+    legacy_entries = pd.DataFrame(orders, columns=['prdx', '商品コード', 'セット', '発注数量', '制限数量'])
+    pd.testing.assert_frame_equal(legacy_entries[['prdx', '商品コード', 'セット', '発注数量']],
+                                  plan.entries[['prdx', '商品コード', 'セット', '発注数量']], check_dtype=False)
+    assert len(error_codes) == len(plan.errors) - int(plan.entries['MAX超え'].sum())
+
+def make_order_plan_case(rows):
+    values_food, _ = make_sheet_values(rows)
+    input_df, _ = normalize_food(values_food)
+    return input_df, make_order_table(input_df)
+
+def bench_order_plan(rows=3000):
+    input_df, table_rows = make_order_plan_case(rows)
+    check_order_plan(input_df, table_rows)
+    legacy = measure(legacy_plan, input_df, table_rows)
+    fast = measure(fast_plan, input_df, table_rows)
+    print(f"入力内容の作成 {rows}行: 従来 {legacy * 1000:.1f}ms / 新 {fast * 1000:.1f}ms（{legacy / fast:.2f}倍）")
+    return legacy / fast
+
+# 計測する処理と行数（行数を増やしたときの伸び方も確認する）
+SUITE = [
+    ('csv_filter', bench_csv_filter, [5000, 50000]),
+    ('sheet_normalize', bench_sheet_normalize, [300, 3000]),
+    ('order_plan', bench_order_plan, [300, 3000])
+]
+
+# 読み込み時間を計測するモジュールと、起動時に読み込まれてはいけない重いモジュール
+IMPORT_MODULES = ['Automation', 'pipeline', 'tracing', 'async_client']
+HEAVY_MODULES = ['selenium', 'pandas', 'openpyxl', 'qrcode', 'PIL', 'winreg', 'httpx']
+heavy_import_log = [] # (モジュール名, 一緒に読み込まれた重いモジュール)
+import_failures = [] # 読み込めなかったモジュール（依存パッケージがない場合も確認できないので失敗とする）
+
+def import_time(module, repeat=3):
+    # python -X importtimeで新しいプロセスでの読み込み時間（秒）を計測する
+    # 戻り値: (最速の秒数, 一緒に読み込まれた重いモジュール)。読み込めない場合はNone
+    code = f"import sys, {module}; print(','.join(name for name in {HEAVY_MODULES!r} if name in sys.modules))"
+    best, heavy = None, []
+    for _ in range(repeat):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        if result.returncode != 0:
+            print(f"{module}を読み込めません: {(result.stderr.strip().splitlines() or [''])[-1]}")
+            return None
+        for line in result.stderr.splitlines(): # import time: self [us] | cumulative | imported package
+            fields = line.split('|')
+            if len(fields) == 3 and fields[2].strip() == module:
+                seconds = int(fields[1]) / 1e6
+                best = seconds if best is None else min(best, seconds)
+        heavy = [name for name in result.stdout.strip().split(',') if name]
+    return best, heavy
+
+def bench_import_time():
+    results = {}
+    for module in IMPORT_MODULES:
+        measured = import_time(module)
+        if measured is None:
+            import_failures.append(module)
+            continue
+        seconds, heavy = measured
+        print(f"import {module}: {seconds * 1000:.1f}ms" + (f"（起動時に読み込まれている重いモジュール: {', '.join(heavy)}）" if heavy else ''))
+        if heavy:
+            heavy_import_log.append((module, heavy))
+        results[f'import:{module}'] = round(seconds, 6)
+    return results
+
+def run_suite():
+    # 戻り値: {'処理名:行数': 従来の処理に対する速さ（従来の秒数 / 新しい処理の秒数）}
+    return {f'{name}:{rows}': round(bench(rows), 3) for name, bench, sizes in SUITE for rows in sizes}
+
+def compare(results, baseline, threshold):
+    # 従来の処理に対する速さが基準値の1/threshold倍未満に落ちた項目のリスト
+    return [(key, baseline[key], speedup) for key, speedup in results.items()
+            if key in baseline and speedup < baseline[key] / threshold]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='オフラインのデータ処理のベンチマーク')
+    parser.add_argument('--baseline', default='benchmark_baseline.json', help='基準値のファイル')
+    parser.add_argument('--save-baseline', action='store_true', help='結果を基準値として保存')
+    parser.add_argument('--threshold', type=float, default=1.5, help='従来に対する速さが基準値の何分の1より遅い場合に失敗とするか')
+    args = parser.parse_args(argv)
+
+    results = run_suite()
+    bench_import_time()
+    if heavy_import_log or import_failures: # 重いモジュールを起動時に読み込むように戻ってしまった場合・確認できない場合は基準値に関係なく失敗
+        return 1
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+        print(f"基準値を保存しました: {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"基準値がありません（--save-baselineで保存）: {args.baseline}")
+        return 0
+    with open(args.baseline, 'r', encoding='utf-8') as file:
+        baseline = json.load(file)
+    regressions = compare(results, baseline, args.threshold)
+    for key, base, speedup in regressions:
+        print(f"遅くなりました: {key} 従来の{base:.2f}倍 → {speedup:.2f}倍")
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,305 @@
+# © 2024 Keita Iwasa
+# 動作確認用のEOSの代替（ローカルのHTTPサーバー）
+# 本番のEOSに発注せずに、download_csv・input_order_in_siteの変更を確認・計測するために使う
+#
+# 起動方法: python eos_replica.py serve --port 8765
+# config.iniのSettingsに以下を書くと、AutomationHandlerがこのサーバーに接続する
+#   EOS_MODE = replica
+#   EOS_REPLICA_URL = http://127.0.0.1:8765/st/
+#   CSV_EXPORT_PATH = csvout   （HTTPでのCSVダウンロードを確認する場合）
+#
+# 入力速度の計測: python eos_replica.py bench --rows 300
+#
+# 画面の要素（id・class）は、Automation.pyが参照しているものだけを再現している
+#   ログイン: txtUserId, txtPassword, btnLogin, パスワード誤りのメッセージ, 別ページで開かれている場合のbtnNext
+#   メニュー: menupng2, accesskey=3（発注入力）, accesskey=4（発注照会）, お知らせの✕ボタン（title=Close）
+#   発注入力: scode, syhnnm*, prdx*（data-sthtsu, data-sgosuu）, pushDay2（非食品のタブ）, divDialog（制限数量）
+#   発注照会: selectFromYaer/Month/Day, inquiryButton, btnCsvoutConfirm, はい
+
+import argparse
+import json
+import random
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, quote
+
+from benchmark import make_eos_csv
+
+SESSION_COOKIE = 'EOSSESSION'
+
+def make_catalog(food_rows=300, nonfood_rows=30, seed=0):
+    # EOSのお気に入り商品（食品・非食品）を模した合成データ
+    rng = random.Random(seed)
+    food = [{'code': 100000 + i, 'name': f'商品{i}', 'set': rng.choice([1, 6, 12]), 'limit': rng.choice([0, 0, 0, 50, 100])}
+            for i in range(food_rows)]
+    nonfood = [{'code': 200000 + i, 'name': f'資材{i}', 'set': 1, 'limit': 0} for i in range(nonfood_rows)]
+    return {'food': food, 'nonfood': nonfood}
+
+def make_sheet_values(catalog, seed=0):
+    # catalogに対応する発注書（getSpreadsheetの戻り値 values_food, values_nonfood）
+    rng = random.Random(seed)
+    values_food = [['商品名', 'セット', '商品コード', '現在庫', '発注数']]
+    for item in catalog['food']:
+        values_food.append([item['name'], item['set'], item['code'], rng.randint(0, 30), rng.randint(0, 10)])
+    values_nonfood = [['商品名', '商品コード', '発注数']]
+    for item in catalog['nonfood']:
+        values_nonfood.append([item['name'], item['code'], rng.choice(['', 0, 1, 2])])
+    return values_food, values_nonfood
+
+PAGE = """<!DOCTYPE html>
+<html lang="ja"><head><meta charset="utf-8"><title>EOS (replica)</title>
+<style>
+#divDialog, .notice {{ position: absolute; top: 80px; left: 80px; background: #fff; border: 1px solid #333; padding: 16px; }}
+.submenu {{ display: none; }}
+</style></head>
+<body>{body}</body></html>
+"""
+
+LOGIN_BODY = """
+<form method="post" action="login">
+  <input id="txtUserId" name="user_id">
+  <input id="txtPassword" name="password" type="password">
+  <button id="btnLogin" type="submit">ログイン</button>
+</form>
+{error}
+"""
+
+ALREADY_OPEN_BODY = """
+<p>別のページでEOSが開かれています。</p>
+<form method="post" action="login"><input type="hidden" name="next" value="1"><button id="btnNext" type="submit">開く</button></form>
+"""
+
+MENU = """
+<div class="menupng2" onclick="document.querySelectorAll('.submenu').forEach((menu) => menu.style.display = 'block');">発注</div>
+<div class="submenu"><a accesskey="3" href="order">発注入力</a></div>
+<div class="submenu"><a accesskey="4" href="inquiry">発注照会</a></div>
+"""
+
+NOTICE = """<div class="notice">お知らせ（動作確認用）<button title="Close" onclick="this.parentNode.remove();">×</button></div>"""
+
+ORDER_BODY = """
+<div class="pushDay1" onclick="render('food');">食品</div>
+<div class="pushDay2" onclick="render('nonfood');">非食品</div>
+<table id="grid"></table>
+<div id="divDialog" style="display: none;"><span id="dialogText"></span><span class="ui-icon-closethick" onclick="closeDialog();">×</span></div>
+<script>
+const catalog = {catalog};
+window.entered = {{}}; // prdx: 入力数（タブを切り替えても保持）
+const closeDialog = () => {{ document.getElementById('divDialog').style.display = 'none'; }};
+const onInput = (input) => {{
+    const value = parseInt(input.value, 10) || 0;
+    const limit = parseInt(input.getAttribute('data-sgosuu'), 10);
+    if (limit > 0 && value >= limit) {{
+        document.getElementById('dialogText').textContent = '制限数量を超えています。（制限数量：' + limit + '）';
+        document.getElementById('divDialog').style.display = 'block';
+        return;
+    }}
+    window.entered[input.id] = value;
+}};
+const render = (kind) => {{
+    const grid = document.getElementById('grid');
+    grid.innerHTML = '';
+    catalog[kind].forEach((item, i) => {{
+        const id = 'prdx' + kind + i;
+        const row = grid.insertRow();
+        row.innerHTML = '<td><span class="scode">' + item.code + '</span></td>' +
+            '<td><span id="syhnnm' + kind + i + '">' + item.name + '</span></td>' +
+            '<td><input id="' + id + '" data-sthtsu="' + item.set + '" data-sgosuu="' + item.limit + '" value="' + (window.entered[id] || 0) + '"></td>';
+        ['input', 'change'].forEach((type) => row.querySelector('input').addEventListener(type, (event) => onInput(event.target)));
+    }});
+}};
+render('food');
+</script>
+"""
+
+INQUIRY_BODY = """
+<select id="selectFromYaer">{years}</select>
+<select id="selectFromMonth">{months}</select>
+<select id="selectFromDay">{days}</select>
+<button id="inquiryButton" onclick="document.getElementById('result').style.display = 'block';">照会</button>
+<div id="result" style="display: none;">
+  <p>発注明細</p>
+  <button id="btnCsvoutConfirm" onclick="document.getElementById('confirm').style.display = 'block';">CSV出力</button>
+  <div id="confirm" style="display: none;"><span onclick="location.href = 'csvout';">はい</span></div>
+</div>
+"""
+
+class ReplicaState:
+    # サーバー全体で共有する状態（ログイン情報・商品・CSV）
+    def __init__(self, user_id='test', password='test', catalog=None, today=None, already_open=False, notice=True, csv_rows=2000):
+        self.user_id = user_id
+        self.password = password
+        self.catalog = catalog or make_catalog()
+        self.today = today or datetime.today()
+        self.already_open = already_open # 別ページで開かれている場合の画面（btnNext）を表示する
+        self.notice = notice # ログイン後にお知らせのダイアログを表示する
+        self.csv_text = make_eos_csv(csv_rows, today=self.today)
+        self.sessions = set()
+        self.lock = threading.Lock()
+
+class ReplicaRequestHandler(BaseHTTPRequestHandler):
+    state = None # make_serverで設定
+
+    def log_message(self, format, *args): # アクセスログは出さない
+        pass
+
+    def session_id(self):
+        for cookie in self.headers.get('Cookie', '').split(';'):
+            name, _, value = cookie.strip().partition('=')
+            if name == SESSION_COOKIE and value in self.state.sessions:
+                return value
+        return None
+
+    def send_page(self, body, status=200, headers=None):
+        content = PAGE.format(body=body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def redirect(self, location, headers=None):
+        self.send_response(302)
+        self.send_header('Location', location)
+        self.send_header('Content-Length', '0')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+
+    def do_GET(self):
+        self.route(urlsplit(self.path).path, {})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', '0'))
+        form = {key: values[0] for key, values in parse_qs(self.rfile.read(length).decode('utf-8')).items()}
+        self.route(urlsplit(self.path).path, form)
+
+    def route(self, path, form):
+        page = path[len('/st/'):] if path.startswith('/st/') else None
+        if page is None:
+            return self.redirect('/st/')
+        if page == '':
+            if self.state.already_open:
+                return self.send_page(ALREADY_OPEN_BODY)
+            return self.send_page(LOGIN_BODY.format(error=''))
+        if page == 'login':
+            return self.login(form)
+        if self.session_id() is None: # 未ログイン・セッション切れ
+            return self.redirect('/st/')
+        if page == 'osirase':
+            return self.send_page(MENU + (NOTICE if self.state.notice else ''))
+        if page == 'order':
+            return self.send_page(MENU + ORDER_BODY.format(catalog=json.dumps(self.state.catalog, ensure_ascii=False)))
+        if page == 'inquiry':
+            return self.send_page(MENU + INQUIRY_BODY.format(
+                years=''.join(f'<option value="{year}">{year}</option>' for year in range(self.state.today.year - 1, self.state.today.year + 1)),
+                months=''.join(f'<option value="{month}">{month}</option>' for month in range(1, 13)),
+                days=''.join(f'<option value="{day}">{day}</option>' for day in range(1, 32))))
+        if page == 'csvout':
+            return self.send_csv()
+        self.send_error(404)
+
+    def login(self, form):
+        if form.get('next') != '1' and (form.get('user_id') != self.state.user_id or form.get('password') != self.state.password):
+            return self.send_page(LOGIN_BODY.format(error='<div>ユーザーまたはパスワードが一致しませんでした</div>'))
+        session_id = f'{random.getrandbits(64):016x}'
+        with self.state.lock:
+            self.state.sessions.add(session_id)
+        self.redirect('/st/osirase', {'Set-Cookie': f'{SESSION_COOKIE}={session_id}; Path=/st/'})
+
+    def send_csv(self):
+        content = self.state.csv_text.encode('utf-8')
+        filename = quote(f"{self.state.today.strftime('%Y%m%d')}_発注.CSV")
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/csv; charset=utf-8')
+        self.send_header('Content-Disposition', f"attachment; filename*=UTF-8''{filename}")
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+def make_server(state, host='127.0.0.1', port=8765):
+    # port=0の場合は空いているポートを使う。戻り値: (server, EOS_REPLICA_URLに設定するURL)
+    handler_class = type('BoundReplicaRequestHandler', (ReplicaRequestHandler,), {'state': state})
+    server = ThreadingHTTPServer((host, port), handler_class)
+    return server, f'http://{host}:{server.server_address[1]}/st/'
+
+def start_server(state, host='127.0.0.1', port=0):
+    # バックグラウンドのスレッドでサーバーを起動する
+    server, url = make_server(state, host, port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, url
+
+def bench_entry(rows=300, bulk=True, download=False, budget_per_row=None):
+    # 代替EOSに対してinput_order_in_site（とdownload_csv）を実行し、入力速度（行/秒）を計測する
+    # 入力後の画面の値がOrderPlanと一致することも確認する（ChromeとSeleniumが必要）
+    # budget_per_rowを指定すると、入力1行あたりのWebDriverの呼び出しが上限を超えた場合にCommandBudgetExceeded
+    from Automation import AutomationHandler # サーバーだけを起動する場合は読み込まない
+
+    state = ReplicaState(catalog=make_catalog(rows, max(1, rows // 10)))
+    server, url = start_server(state)
+    settings = {'EOS_MODE': 'replica', 'EOS_REPLICA_URL': url, 'EOS_ID': state.user_id, 'EOS_PW': state.password,
+                'BULK_INPUT': str(bulk), 'DOWNLOAD_DIR': tempfile.mkdtemp(prefix='eos_replica_')}
+    handler = AutomationHandler(settings)
+    try:
+        if download:
+            start = time.perf_counter()
+            status = handler.download_csv(state.today.strftime('%Y%m%d'), state.today)
+            print(f"download_csv: {status} {time.perf_counter() - start:.2f}秒")
+        handler.load_order_sheet(*make_sheet_values(state.catalog))
+        start = time.perf_counter()
+        login_status_code = handler.ensure_eos_session(state.user_id, state.password)
+        login_seconds = time.perf_counter() - start
+        profiler = handler.timeline.profiler
+        commands_at_start = profiler.total
+        start = time.perf_counter()
+        input_order_success, error_ls = handler.input_order_in_site()
+        input_seconds = time.perf_counter() - start
+        expected = {prdx: value for plan in handler.order_plans for prdx, value in plan.vector()}
+        print(f"WebDriverの呼び出し(入力): {profiler.total - commands_at_start}回")
+        print(profiler.summary())
+        if budget_per_row is not None:
+            profiler.check_budget(commands_at_start, max(1, len(expected)), budget_per_row)
+        entered = handler.driver.execute_script('return window.entered;')
+        mismatches = {prdx: (value, entered.get(prdx)) for prdx, value in expected.items() if entered.get(prdx) != value}
+        print(f"ログイン: {login_status_code} {login_seconds:.2f}秒")
+        print(f"入力({'一括' if bulk else '1行ずつ'}): {len(expected)}行 {input_seconds:.2f}秒（{len(expected) / input_seconds:.1f}行/秒） エラー{len(error_ls) if input_order_success else error_ls}件")
+        if mismatches:
+            print(f"入力値の不一致: {mismatches}")
+        return not mismatches
+    finally:
+        handler.destroy_chrome()
+        server.shutdown()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='動作確認用のEOSの代替を起動します。')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    serve_parser = subparsers.add_parser('serve', help='サーバーを起動')
+    serve_parser.add_argument('--port', type=int, default=8765)
+    serve_parser.add_argument('--rows', type=int, default=300, help='食品の商品数')
+    serve_parser.add_argument('--already-open', action='store_true', help='別ページで開かれている場合の画面を表示')
+    bench_parser = subparsers.add_parser('bench', help='入力速度を計測')
+    bench_parser.add_argument('--rows', type=int, default=300, help='食品の商品数')
+    bench_parser.add_argument('--row-by-row', action='store_true', help='1行ずつ入力する場合を計測')
+    bench_parser.add_argument('--download', action='store_true', help='download_csvも実行')
+    bench_parser.add_argument('--budget-per-row', type=float, help='入力1行あたりのWebDriverの呼び出し回数の上限（超えた場合は失敗）')
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        state = ReplicaState(catalog=make_catalog(args.rows, max(1, args.rows // 10)), already_open=args.already_open)
+        server, url = make_server(state, port=args.port)
+        print(f"EOS_REPLICA_URL = {url}（ID: {state.user_id} / パスワード: {state.password}）")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.shutdown()
+        return 0
+    return 0 if bench_entry(args.rows, not args.row_by_row, args.download, args.budget_per_row) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
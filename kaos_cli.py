@@ -0,0 +1,59 @@
+# © 2024 Keita Iwasa
+# KAOSのコマンドライン実行（GUIなし）
+# 実行方法: python kaos_cli.py run --stage download,generate
+# タスクスケジューラから開店前に実行しておくと、スタッフがアプリを開いたときに発注書が作成済みになる
+
+import argparse
+import logging
+import os
+import sys
+from datetime import datetime
+
+from Automation import AutomationHandler
+from pipeline import OrderPipeline
+from tracing import timeline_path
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='kaos', description='KAOSの発注処理をGUIなしで実行します。')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run_parser = subparsers.add_parser('run', help='指定した処理を実行')
+    run_parser.add_argument('--stage', default='download,generate', help=f"実行する処理（カンマ区切り: {','.join(OrderPipeline.HEADLESS_STAGES)}）")
+    run_parser.add_argument('--date', help='発注日（YYYY-MM-DD, 省略時は本日）')
+    args = parser.parse_args(argv)
+
+    stages = [stage.strip() for stage in args.stage.split(',') if stage.strip()]
+    unknown_stages = [stage for stage in stages if stage not in OrderPipeline.STAGES]
+    if unknown_stages:
+        parser.error(f"不明な処理: {', '.join(unknown_stages)}")
+    gui_only_stages = [stage for stage in stages if stage in OrderPipeline.GUI_ONLY_STAGES]
+    if gui_only_stages:
+        parser.error(f"GUIでのみ実行できる処理です（入力した発注数を確認する前にブラウザを閉じるため）: {', '.join(gui_only_stages)}")
+    today_int = datetime.strptime(args.date, '%Y-%m-%d') if args.date else None
+
+    # logging設定（GUIと同じくerror_logフォルダに保存）
+    if not os.path.exists('error_log'):
+        os.makedirs('error_log')
+    log_file = os.path.join('error_log', f"cli_log_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.txt")
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s',
+                        handlers=[logging.FileHandler(log_file, encoding='utf-8'), logging.StreamHandler()])
+
+    handler = AutomationHandler()
+    handler.timeline.path = timeline_path(log_file) # ログと同じフォルダにタイムラインを保存
+    pipeline = OrderPipeline(handler, today_int)
+    try:
+        timings = pipeline.run(stages)
+    except Exception as e:
+        logging.exception(e)
+        print(f"失敗: {e}")
+        return 1
+    finally:
+        handler.destroy_chrome()
+    print(f"完了: {timings}")
+    if handler.timeline.profiler.total > 0:
+        print(handler.timeline.profiler.summary())
+    if pipeline.sheet_url:
+        print(f"発注書: {pipeline.sheet_url}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
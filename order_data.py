@@ -0,0 +1,156 @@
+# © 2024 Keita Iwasa
+# 発注データの処理（ブラウザ・ネットワーク・Windowsに依存しない部分）
+
+import importlib.util
+import numpy as np
+import pandas as pd
+
+# 発注明細CSVで納品日の判定に使う列
+DELIVERY_DATE_COLUMNS = ['納品予定日', '納品日']
+
+def read_eos_csv(file, usecols=None, dtype=None, engine='c'):
+    # EOSの発注明細CSVを読み込む
+    # 納品日の列は値の種類が少ないのでカテゴリ型で読み込む（読み込みと日付変換が速くなる）
+    # それ以外の列は従来通り型推定する（GASに送るCSVの表記を変えないため）
+    # engine='pyarrow'はpyarrowがインストールされている場合のみ使用する
+    if engine == 'pyarrow' and importlib.util.find_spec('pyarrow') is None:
+        engine = 'c'
+    column_dtype = {column: 'category' for column in DELIVERY_DATE_COLUMNS}
+    if dtype:
+        column_dtype.update(dtype)
+    return pd.read_csv(file, usecols=usecols, dtype=column_dtype, engine=engine, encoding='utf-8')
+
+def parse_eos_date(series):
+    # 'YYYY-MM-DD(曜)'形式の日付を日付型に変換（曜日は無視）
+    # 日付の種類は少ないので、カテゴリごとに1回だけ変換して各行に展開する
+    # 空欄のセルのカテゴリ番号は-1なので、NaTにする（fill_valueを省略すると最後のカテゴリになる）
+    categorical = series.astype('category')
+    dates = pd.to_datetime(categorical.cat.categories.astype(str).str.slice(0, 10), format='%Y-%m-%d', errors='coerce')
+    return pd.Series(dates.take(categorical.cat.codes.to_numpy(), allow_fill=True, fill_value=pd.NaT), index=series.index)
+
+def filter_delivery_date(df, delivery_date):
+    # 納品予定日または納品日がdelivery_dateの行を抽出
+    delivery_date = pd.Timestamp(delivery_date).normalize()
+    mask = pd.Series(False, index=df.index)
+    for column in DELIVERY_DATE_COLUMNS:
+        mask |= parse_eos_date(df[column]) == delivery_date
+    return df[mask]
+
+# 発注書（スプレッドシート）から使う列
+FOOD_COLUMNS = ['商品名', 'セット', '商品コード', '現在庫', '発注数']
+NONFOOD_COLUMNS = ['商品名', '商品コード', '発注数']
+
+def sheet_frame(values, columns):
+    # シートの値（1行目が見出し）から必要な列だけをDataFrameにする
+    # GASは行末の空セルを省略するので、足りないセルはNoneとして扱う
+    header, rows = values[0], values[1:]
+    data = {}
+    for column in columns:
+        index = header.index(column)
+        data[column] = pd.Series([row[index] if index < len(row) else None for row in rows], dtype=object)
+    return pd.DataFrame(data)
+
+def to_int64(series):
+    # 数値に変換できないセル（空欄・文字列）はNAとする。小数は従来（astype(int)）通り0の方向に切り捨て（-1.5は-1）
+    numeric = pd.to_numeric(series, errors='coerce')
+    return numeric.where(numeric.isna(), np.trunc(numeric)).astype('Int64')
+
+def normalize_food(values_food): # return 食品のdf, 現在庫が入力されていない商品名のリスト
+    # 商品コードが数値でない行（見出し・区切りの行）は除く
+    df = sheet_frame(values_food, FOOD_COLUMNS)
+    codes = to_int64(df['商品コード'])
+    df = pd.DataFrame({
+        '商品名': df['商品名'].replace('', None),
+        'セット': to_int64(df['セット']).fillna(0),
+        '商品コード': codes,
+        '現在庫': to_int64(df['現在庫']),
+        '発注数': to_int64(df['発注数']).fillna(0)
+    })[codes.notna()]
+    missing_names = df.loc[df['現在庫'].isna(), '商品名'].tolist()
+    return df, missing_names
+
+def normalize_nonfood(values_nonfood): # return 非食品のdf（発注数が入力されている行のみ）
+    df = sheet_frame(values_nonfood, NONFOOD_COLUMNS)
+    df = pd.DataFrame({
+        '商品名': df['商品名'].replace('', None),
+        '商品コード': to_int64(df['商品コード']),
+        '発注数': to_int64(df['発注数'])
+    })
+    df = df[df['発注数'].notna() & (df['発注数'] != 0)].reset_index(drop=True)
+    invalid_names = df.loc[df['商品コード'].isna(), '商品名'].tolist()
+    if invalid_names:
+        raise ValueError(f"非食品の商品コードが正しくありません: {', '.join(map(str, invalid_names))}")
+    return df
+
+class OrderPlan:
+    # EOSに入力する内容（ブラウザを操作する前にまとめて計算する）
+    # 発注書のdfから発注数が1以上の行を取り出し、compileでEOSの商品一覧（snapshot_order_table）と照合して
+    # prdxごとの入力数（セット数の倍数・制限数量を反映済み）とエラーを求める
+    # entriesの発注数量はセット数×発注書の発注数（制限数量を反映する前の数量）
+    ENTRY_COLUMNS = ['prdx', '商品コード', '商品名', 'セット', '発注数量', '入力数', '制限数量', 'MAX超え']
+
+    def __init__(self, df, kind='food'):
+        self.kind = kind # 'food' または 'nonfood'（非食品はEOSの別タブ）
+        columns = ['商品名', '商品コード', '発注数'] + (['セット'] if 'セット' in df.columns else [])
+        self.requests = df.loc[df['発注数'].fillna(0) > 0, columns].reset_index(drop=True)
+        self.names = dict(zip(df['商品コード'], df['商品名'])) # 商品コード：商品名
+        self.entries = None
+        self.errors = [] # 入力できない商品（error_lsに追加する）
+        self.set_mismatches = [] # 発注書とEOSのセット数が一致しない商品コード
+
+    def __len__(self):
+        return len(self.requests)
+
+    def compile(self, table_rows):
+        # EOSの商品一覧を列ごとの配列にして、発注書の商品コードとまとめて照合する（同じ商品コードは最初の行を使う）
+        table_codes = pd.Index(pd.to_numeric(pd.Series([row['code'] for row in table_rows], dtype=object), errors='coerce'))
+        first = ~table_codes.duplicated()
+        matched = table_codes[first].get_indexer(self.requests['商品コード'].to_numpy(dtype='int64', na_value=-1))
+        found = matched >= 0
+        rows = np.flatnonzero(first)[matched[found]] # 発注書の各行に対応するEOSの行
+
+        missing = self.requests[~found]
+        self.errors = [f"{code}：{name}（エラー理由：EOSに存在しない商品, 商品番号の誤り, お気に入り未登録）"
+                       for code, name in zip(missing['商品コード'], missing['商品名'])]
+        requests = self.requests[found]
+
+        prdx = np.array([row['prdx'] for row in table_rows], dtype=object)[rows]
+        set_value = pd.to_numeric(pd.Series([row['set'] for row in table_rows], dtype=object), errors='coerce').fillna(1).to_numpy(dtype='int64')[rows] # セット数（EOS由来）
+        limit = pd.to_numeric(pd.Series([row['limit'] for row in table_rows], dtype=object), errors='coerce').to_numpy(dtype='float64')[rows]
+        order_value = set_value * requests['発注数'].to_numpy(dtype='int64')
+        # 制限数量以上は入力できないので、制限数量を超えない最大のセット数の倍数にする
+        over_limit = (limit > 0) & (order_value >= limit)
+        max_input = np.floor((np.nan_to_num(limit) - 1) / set_value) * set_value
+        input_value = np.where(over_limit, max_input, order_value).astype('int64')
+
+        if 'セット' in requests.columns:
+            self.set_mismatches = requests.loc[requests['セット'].to_numpy(dtype='int64', na_value=0) != set_value, '商品コード'].tolist()
+        self.entries = pd.DataFrame({
+            'prdx': prdx,
+            '商品コード': requests['商品コード'].to_numpy(),
+            '商品名': requests['商品名'].to_numpy(),
+            'セット': set_value,
+            '発注数量': order_value,
+            '入力数': input_value,
+            '制限数量': limit,
+            'MAX超え': over_limit
+        }, columns=self.ENTRY_COLUMNS)
+        self.errors += [f'{code}：{name}（エラー理由：発注数MAX超え）'
+                        for code, name in zip(requests['商品コード'][over_limit], requests['商品名'][over_limit])]
+        return self
+
+    def vector(self): # BULK_INPUT_SCRIPTに渡す[[prdx, 入力数], ...]
+        return [[prdx, int(value)] for prdx, value in zip(self.entries['prdx'], self.entries['入力数'])]
+
+    def orders(self): # 1行ずつ入力する場合の(prdx, 商品コード, セット数, 入力数, 制限数量)
+        return [(prdx, code, int(set_value), int(value), None if pd.isna(limit) else int(limit))
+                for prdx, code, set_value, value, limit in self.entries[['prdx', '商品コード', 'セット', '入力数', '制限数量']].itertuples(index=False, name=None)]
+
+    def records(self): # ログ・確認用
+        return self.entries.astype(object).where(self.entries.notna(), None).to_dict('records')
+
+    def diff(self, other): # 前回のplanからの入力数の変更 {prdx: (前回, 今回)}
+        previous = dict(zip(other.entries['prdx'], other.entries['入力数'])) if other is not None and other.entries is not None else {}
+        current = dict(zip(self.entries['prdx'], self.entries['入力数']))
+        return {prdx: (previous.get(prdx), current.get(prdx))
+                for prdx in sorted(previous.keys() | current.keys()) if previous.get(prdx) != current.get(prdx)}
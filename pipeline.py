@@ -0,0 +1,102 @@
+# © 2024 Keita Iwasa
+# 発注処理の流れ（GUIに依存しない）
+# GUI（KAOS.3.7.py）・コマンドライン（kaos_cli.py）・複数店舗の一括実行（batch_runner.py）で共通して使う
+
+import logging
+import time
+from datetime import datetime, timedelta
+
+from tracing import traced
+
+class OrderPipeline:
+    # 処理の段階（runで指定できる名前）
+    # check: 作成済みの発注書の確認, download: 発注明細のダウンロード, generate: 発注書の作成,
+    # fetch: 発注書の取得, input: EOSへの発注数の入力
+    STAGES = ['check', 'download', 'generate', 'fetch', 'input']
+    # GUIでのみ実行できる段階（入力した発注数はスタッフが画面で確認するので、入力後にブラウザを閉じるコマンドラインでは実行しない）
+    GUI_ONLY_STAGES = ['input']
+    HEADLESS_STAGES = ['check', 'download', 'generate', 'fetch']
+
+    def __init__(self, handler, today_int=None):
+        self.handler = handler
+        self.timeline = handler.timeline # 段階ごとの処理時間はAutomationHandlerのタイムラインに記録
+        self.today_int = today_int or datetime.today()
+        self.today_str = self.today_int.strftime('%Y-%m-%d')
+        self.today_str_csv = self.today_int.strftime('%Y%m%d')
+        self.delivery_date_int = self.today_int + timedelta(days=2) #納品日(明後日)
+        self.sheet_name = f'発注書_{self.today_str}'
+        self.sheet_id = False
+        self.sheet_url = False
+        self.NaN_ls = None # 現在庫が入力されていない商品名のリスト
+        self.df_nonfood = None
+        self.error_ls = [] # EOSへの入力エラー
+
+    @traced('stage:check')
+    def check(self, prefetched=None): # return 作成済みの発注書があるか
+        # prefetched: 起動時にまとめて取得した結果（発注書名, check_existing_sheetの戻り値）
+        if prefetched is not None and prefetched[0] == self.sheet_name:
+            check_result = prefetched[1]
+        else:
+            check_result = self.handler.check_existing_sheet(self.sheet_name)
+        if check_result == False:
+            self.sheet_id, self.sheet_url = False, False
+            return False
+        self.sheet_id, self.sheet_url = check_result
+        return True
+
+    @traced('stage:download')
+    def download(self): # return ステータスコード（"200", "E0005", "E0006", "E0007"）
+        return self.handler.download_csv(self.today_str_csv, self.today_int)
+
+    @traced('stage:generate')
+    def generate(self): # return 発注書を作成できたか
+        generate_result = self.handler.generate_form(self.delivery_date_int, self.today_str)
+        if generate_result == False:
+            return False
+        self.sheet_id, self.sheet_url = generate_result
+        return True
+
+    @traced('stage:fetch')
+    def fetch(self): # return 現在庫が入力されていない商品名のリスト, 非食品のdf
+        self.NaN_ls, self.df_nonfood = self.handler.get_spreadsheet(self.sheet_id)
+        return self.NaN_ls, self.df_nonfood
+
+    @traced('stage:input')
+    def input(self): # return 入力できたか, エラーリストまたはステータスコード
+        input_order_success, self.error_ls = self.handler.input_order_in_site()
+        return input_order_success, self.error_ls
+
+    def run(self, stages): # return 段階ごとの所要時間（秒）
+        # GUIなしで指定した段階を順に実行する。失敗した場合は例外を送出
+        # generateはdownloadで抽出した発注明細を使うので、先にdownloadを実行する必要がある
+        if 'generate' in stages and 'download' not in stages[:stages.index('generate')]:
+            raise ValueError("generateの前にdownloadを指定してください")
+        timings = {}
+        for stage in stages:
+            start = time.monotonic()
+            if stage == 'check':
+                self.check()
+            elif stage == 'download':
+                download_status = self.download()
+                if download_status != "200":
+                    raise Exception(f"発注明細のダウンロードに失敗しました: {download_status}")
+            elif stage == 'generate':
+                if not self.generate():
+                    raise Exception("発注書の作成に失敗しました")
+            elif stage == 'fetch':
+                if not self.sheet_id and not self.check(): # 作成済みの発注書を使う
+                    raise Exception("本日の発注書が見つかりません")
+                NaN_ls, _ = self.fetch()
+                if NaN_ls is False:
+                    raise Exception("発注書からデータを取得できませんでした")
+                if NaN_ls:
+                    raise Exception(f"現在庫が入力されていない商品があります: {', '.join(NaN_ls)}")
+            elif stage == 'input':
+                input_order_success, error_ls = self.input()
+                if not input_order_success:
+                    raise Exception(f"EOSへの入力に失敗しました: {error_ls}")
+            else:
+                raise ValueError(f"不明な処理: {stage}")
+            timings[stage] = round(time.monotonic() - start, 2)
+            logging.info(f"{stage}: {timings[stage]}秒")
+        return timings
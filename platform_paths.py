@@ -0,0 +1,48 @@
+# © 2024 Keita Iwasa
+# OSごとに異なるパスの取得（Windowsはレジストリ、それ以外は標準的な場所）
+# winregはWindowsにしかないので、使うときに読み込む
+
+import os
+import shutil
+import subprocess
+import sys
+
+def downloads_folder():
+    # ユーザーのダウンロードフォルダ
+    if sys.platform == 'win32':
+        import winreg
+        sub_key = r'SOFTWARE\Microsoft\Windows\CurrentVersion\Explorer\Shell Folders'
+        key = winreg.OpenKey(winreg.HKEY_CURRENT_USER, sub_key)
+        try:
+            return winreg.QueryValueEx(key, '{374DE290-123F-4565-9164-39C4925E467B}')[0]
+        finally:
+            winreg.CloseKey(key)
+    if sys.platform.startswith('linux'):
+        # XDGのユーザーディレクトリ（日本語環境では「ダウンロード」の場合がある）
+        try:
+            folder = subprocess.run(['xdg-user-dir', 'DOWNLOAD'], capture_output=True, text=True, timeout=5).stdout.strip()
+            if folder and folder != os.path.expanduser('~'):
+                return folder
+        except (OSError, subprocess.SubprocessError):
+            pass
+    return os.path.join(os.path.expanduser('~'), 'Downloads')
+
+def chrome_path():
+    # Google Chromeの実行ファイル（見つからない場合はNone）
+    if sys.platform == 'win32':
+        import winreg
+        try:
+            reg_key = winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, r"SOFTWARE\Microsoft\Windows\CurrentVersion\App Paths\chrome.exe")
+            chrome_path, _ = winreg.QueryValueEx(reg_key, "")
+            winreg.CloseKey(reg_key)
+            return chrome_path
+        except OSError:
+            return None
+    if sys.platform == 'darwin':
+        path = '/Applications/Google Chrome.app/Contents/MacOS/Google Chrome'
+        return path if os.path.exists(path) else None
+    for name in ['google-chrome', 'google-chrome-stable', 'chromium', 'chromium-browser']:
+        path = shutil.which(name)
+        if path:
+            return path
+    return None
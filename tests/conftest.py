@@ -0,0 +1,71 @@
+# © 2024 Keita Iwasa
+# テストからリポジトリ直下のモジュール（order_data.pyなど）を読み込めるようにする
+# GASの代わりのローカルのHTTPサーバー（gas_stub）と、そこに接続するAutomationHandler（gas_handler）
+
+import json
+import os
+import sys
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+class GasStub:
+    # 関数名ごとに返す応答 [(ステータス, JSON), ...] を順に返す（最後の応答は繰り返す）
+    # 応答を設定していない関数は200 {}
+    def __init__(self):
+        self.replies = {}
+        self.calls = [] # 受け取った {'function', 'parameters'}
+        self.lock = threading.Lock()
+        self.server = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_port}/exec'
+
+    def reply(self, function_name):
+        with self.lock:
+            replies = self.replies.get(function_name, [(200, {})])
+            return replies.pop(0) if len(replies) > 1 else replies[0]
+
+    def count(self, function_name):
+        return sum(1 for call in self.calls if call['function'] == function_name)
+
+class GasStubRequestHandler(BaseHTTPRequestHandler):
+    stub = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', '0'))).decode('utf-8'))
+        self.stub.calls.append(body)
+        status, reply = self.stub.reply(body['function'])
+        content = json.dumps(reply).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+@pytest.fixture
+def gas_stub():
+    stub = GasStub()
+    request_handler = type('StubRequestHandler', (GasStubRequestHandler,), {'stub': stub})
+    stub.server = ThreadingHTTPServer(('127.0.0.1', 0), request_handler)
+    thread = threading.Thread(target=stub.server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True)
+    thread.start()
+    yield stub
+    stub.server.shutdown()
+    stub.server.server_close()
+
+@pytest.fixture
+def gas_handler(gas_stub, tmp_path):
+    # gas_stubに接続し、キャッシュをtmp_pathに保存するAutomationHandler（requestsが必要）
+    pytest.importorskip('requests')
+    from Automation import AutomationHandler, LocalCache
+    handler = AutomationHandler({'SHOP_NAME': 'テスト店', 'SCRIPT_URL': gas_stub.url})
+    handler.cache = LocalCache(str(tmp_path / 'cache.json'))
+    return handler
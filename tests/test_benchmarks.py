@@ -0,0 +1,49 @@
+# © 2024 Keita Iwasa
+# オフラインのデータ処理の従来の処理との一致の確認と、pytest-benchmarkでの計測
+# 計測のみ: python -m pytest tests/test_benchmarks.py --benchmark-only
+# 基準値との比較（CI）はpython benchmark.pyで行う
+
+from datetime import datetime
+
+import pytest
+
+from benchmark import (make_eos_csv, make_sheet_values, make_order_plan_case, check_csv_filter, check_sheet_normalize,
+                       check_order_plan, fast_filter, fast_normalize, fast_plan)
+
+try:
+    import pytest_benchmark
+except ImportError:
+    pytest_benchmark = None
+
+needs_benchmark = pytest.mark.skipif(pytest_benchmark is None, reason='pytest-benchmarkがインストールされていません')
+NEXT_DAY = datetime(2024, 5, 2)
+
+@pytest.mark.parametrize('rows', [5000, 50000])
+def test_csv_filter_matches_legacy(rows):
+    check_csv_filter(make_eos_csv(rows), NEXT_DAY)
+
+@pytest.mark.parametrize('rows', [300, 3000])
+def test_sheet_normalize_matches_legacy(rows):
+    check_sheet_normalize(*make_sheet_values(rows))
+
+@pytest.mark.parametrize('rows', [300, 3000])
+def test_order_plan_matches_legacy(rows):
+    check_order_plan(*make_order_plan_case(rows))
+
+@needs_benchmark
+@pytest.mark.parametrize('rows', [5000, 50000])
+def test_bench_csv_filter(benchmark, rows):
+    benchmark.group = 'csv_filter'
+    benchmark(fast_filter, make_eos_csv(rows), NEXT_DAY)
+
+@needs_benchmark
+@pytest.mark.parametrize('rows', [300, 3000])
+def test_bench_sheet_normalize(benchmark, rows):
+    benchmark.group = 'sheet_normalize'
+    benchmark(fast_normalize, *make_sheet_values(rows))
+
+@needs_benchmark
+@pytest.mark.parametrize('rows', [300, 3000])
+def test_bench_order_plan(benchmark, rows):
+    benchmark.group = 'order_plan'
+    benchmark(fast_plan, *make_order_plan_case(rows))
@@ -0,0 +1,62 @@
+# © 2024 Keita Iwasa
+# ブラウザのCookieを引き継いだHTTPでのCSVダウンロード（download_csv_http）のテスト
+# 動作確認用のEOSの代替（eos_replica.py）にログインし、そのCookieを持つブラウザの代わりのオブジェクトを使う（Chromeは不要）
+
+import os
+from datetime import datetime
+
+import pytest
+
+requests = pytest.importorskip('requests')
+
+from Automation import AutomationHandler
+from eos_replica import ReplicaState, SESSION_COOKIE, start_server
+
+class CookieDriver:
+    # download_csv_httpが使うWebDriverのメソッドだけを持つ（ログイン済みのブラウザのCookie）
+    def __init__(self, cookies):
+        self.cookies = cookies
+
+    def execute_script(self, script):
+        return 'Mozilla/5.0 (replica test)'
+
+    def get_cookies(self):
+        return self.cookies
+
+@pytest.fixture
+def replica():
+    state = ReplicaState(today=datetime(2024, 5, 1), notice=False, csv_rows=200)
+    server, url = start_server(state)
+    yield state, url
+    server.shutdown()
+    server.server_close()
+
+def eos_handler(url, tmp_path, cookies):
+    handler = AutomationHandler({'SHOP_NAME': 'テスト店', 'EOS_MODE': 'replica', 'EOS_REPLICA_URL': url, 'CSV_EXPORT_PATH': 'csvout'})
+    handler.driver = CookieDriver(cookies)
+    handler.csv_path = os.path.join(tmp_path, '20240501_発注.CSV')
+    return handler
+
+def login_cookies(state, url):
+    with requests.Session() as session:
+        response = session.post(url + 'login', data={'user_id': state.user_id, 'password': state.password})
+        response.raise_for_status()
+        return [{'name': cookie.name, 'value': cookie.value, 'path': cookie.path} for cookie in session.cookies]
+
+def test_download_csv_http_uses_browser_cookies(replica, tmp_path):
+    state, url = replica
+    cookies = login_cookies(state, url)
+    assert [cookie['name'] for cookie in cookies] == [SESSION_COOKIE]
+    handler = eos_handler(url, tmp_path, cookies)
+    assert handler.download_csv_http(datetime(2024, 5, 1)) is True
+    with open(handler.csv_path, 'r', encoding='utf-8') as file:
+        assert file.read() == state.csv_text
+    assert not os.path.exists(f'{handler.csv_path}.part')
+
+def test_download_csv_http_without_session_falls_back(replica, tmp_path):
+    # セッションがない場合はログイン画面（HTML）が返るので、保存せずにFalse（画面操作でダウンロードする）
+    state, url = replica
+    handler = eos_handler(url, tmp_path, [{'name': SESSION_COOKIE, 'value': 'expired', 'path': '/st/'}])
+    assert handler.download_csv_http(datetime(2024, 5, 1)) is False
+    assert not os.path.exists(handler.csv_path)
+    assert not os.path.exists(f'{handler.csv_path}.part')
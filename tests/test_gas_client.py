@@ -0,0 +1,171 @@
+# © 2024 Keita Iwasa
+# GAS呼び出しの再試行・中止・キャッシュのテスト（同期版・非同期版）
+
+import asyncio
+import threading
+import time
+from datetime import datetime
+
+import pytest
+
+pytest.importorskip('requests')
+
+from Automation import GasCallCancelled, RetryPolicy
+
+FAST_POLICY = RetryPolicy(max_attempts=3, deadline=10, timeout=5, base_delay=0.01, max_delay=0.01, jitter=0)
+SLOW_POLICY = RetryPolicy(max_attempts=3, deadline=60, timeout=5, base_delay=5, max_delay=5, jitter=0)
+
+@pytest.fixture
+def async_client(gas_handler):
+    pytest.importorskip('httpx')
+    from async_client import AsyncAutomationClient
+    return AsyncAutomationClient(gas_handler)
+
+def run(async_client, coro):
+    async def main():
+        try:
+            return await coro
+        finally:
+            await async_client.close()
+    return asyncio.run(main())
+
+def cancel_later(handler, seconds=0.2):
+    timer = threading.Timer(seconds, handler.cancel_event.set)
+    timer.start()
+    return timer
+
+def test_retries_and_reports_progress(gas_stub, gas_handler):
+    gas_stub.replies['getNotice'] = [(503, {}), (200, {'notices': ['a']})]
+    progress = []
+    gas_handler.gas_progress = lambda function_name, attempt, max_attempts: progress.append((function_name, attempt, max_attempts))
+    assert gas_handler.call_google_script('getNotice', {}, FAST_POLICY) == {'notices': ['a']}
+    assert progress == [('getNotice', 1, 3), ('getNotice', 2, 3)]
+
+def test_does_not_retry_client_errors(gas_stub, gas_handler):
+    gas_stub.replies['getNotice'] = [(400, {})]
+    with pytest.raises(Exception, match='400'):
+        gas_handler.call_google_script('getNotice', {}, FAST_POLICY)
+    assert gas_stub.count('getNotice') == 1
+
+def test_cancel_interrupts_backoff(gas_stub, gas_handler):
+    gas_stub.replies['getNotice'] = [(503, {})]
+    cancel_later(gas_handler)
+    start = time.monotonic()
+    with pytest.raises(GasCallCancelled):
+        gas_handler.call_google_script('getNotice', {}, SLOW_POLICY)
+    assert time.monotonic() - start < 2
+
+def test_cached_call_uses_last_value_on_failure(gas_stub, gas_handler):
+    gas_stub.replies['getOriginalSheet'] = [(200, {'found': True, 'sheet_url': 'url'}), (400, {})]
+    fetch = lambda: gas_handler.call_google_script('getOriginalSheet', {}, FAST_POLICY)
+    assert gas_handler.cached_call('original_sheet', 3600, fetch)['sheet_url'] == 'url'
+    assert gas_handler.cached_call('original_sheet', 0, fetch)['sheet_url'] == 'url' # 期限切れ・取得失敗
+    assert gas_stub.count('getOriginalSheet') == 2
+
+def test_async_retries_and_reports_progress(gas_stub, gas_handler, async_client):
+    gas_stub.replies['getNotice'] = [(503, {}), (200, {'notices': ['a']})]
+    progress = []
+    gas_handler.gas_progress = lambda function_name, attempt, max_attempts: progress.append(attempt)
+    assert run(async_client, async_client.call_google_script('getNotice', {}, FAST_POLICY)) == {'notices': ['a']}
+    assert progress == [1, 2]
+
+def test_async_cancel_interrupts_backoff(gas_stub, gas_handler, async_client):
+    gas_stub.replies['getNotice'] = [(503, {})]
+    cancel_later(gas_handler)
+    start = time.monotonic()
+    with pytest.raises(GasCallCancelled):
+        run(async_client, async_client.call_google_script('getNotice', {}, SLOW_POLICY))
+    assert time.monotonic() - start < 2
+
+def test_async_cached_call_does_not_hide_cancel(gas_stub, gas_handler, async_client):
+    gas_handler.cache.set('original_sheet', {'found': True, 'sheet_url': 'url'})
+    gas_handler.cancel_event.set()
+    fetch = lambda: async_client.call_google_script('getOriginalSheet', {}, FAST_POLICY)
+    with pytest.raises(GasCallCancelled):
+        run(async_client, async_client.cached_call('original_sheet', 0, fetch))
+
+@pytest.fixture
+def startup_handler(gas_handler):
+    # アップデート確認はキャッシュしたversion.jsonを使う（サポートサーバーに接続しない）
+    gas_handler.cache.set('version', {'default': '3.7.0'})
+    return gas_handler
+
+def test_prefetch_startup_batches_gas_calls(gas_stub, startup_handler, async_client):
+    gas_stub.replies['batch'] = [(200, {'results': {
+        'existing_sheet': {'found': True, 'sheet_id': 'id', 'spreadsheet_url': 'url'},
+        'notices': {'notices': []}
+    }})]
+    prefetched = run(async_client, async_client.prefetch_startup('3.7.0', datetime(2024, 5, 1), '発注書_2024-05-01'))
+    assert prefetched['update'] == (False, None)
+    assert prefetched['existing_sheet'] == ('発注書_2024-05-01', ('id', 'url'))
+    assert [call['function'] for call in gas_stub.calls] == ['batch']
+
+def test_prefetch_startup_falls_back_without_batch(gas_stub, startup_handler, async_client):
+    gas_stub.replies['batch'] = [(200, {'error': 'unknown function'})]
+    gas_stub.replies['checkExistingSheet'] = [(200, {'found': False})]
+    gas_stub.replies['getNotice'] = [(200, {'notices': []})]
+    prefetched = run(async_client, async_client.prefetch_startup('3.7.0', datetime(2024, 5, 1), '発注書_2024-05-01'))
+    assert prefetched['existing_sheet'] == ('発注書_2024-05-01', False)
+    assert sorted(call['function'] for call in gas_stub.calls) == ['batch', 'checkExistingSheet', 'getNotice']
+
+def test_batch_unsupported_is_remembered(gas_stub, startup_handler, async_client):
+    from Automation import LocalCache
+    gas_stub.replies['batch'] = [(200, {'error': 'unknown function'})]
+    gas_stub.replies['checkExistingSheet'] = [(200, {'found': False})]
+    gas_stub.replies['getNotice'] = [(200, {'notices': []})]
+    run(async_client, async_client.prefetch_startup('3.7.0', datetime(2024, 5, 1), '発注書_2024-05-01'))
+    startup_handler.cache = LocalCache(startup_handler.cache.path) # 次回の起動
+    run(async_client, async_client.prefetch_startup('3.7.0', datetime(2024, 5, 2), '発注書_2024-05-02'))
+    assert gas_stub.count('batch') == 1
+
+def test_prefetch_startup_does_not_retry(gas_stub, startup_handler, async_client):
+    gas_stub.replies['batch'] = [(503, {})]
+    prefetched = run(async_client, async_client.prefetch_startup('3.7.0', datetime(2024, 5, 1), '発注書_2024-05-01'))
+    assert 'existing_sheet' not in prefetched and prefetched['notices'] is False
+    assert [call['function'] for call in gas_stub.calls] == ['batch']
+
+def test_prefetched_existing_sheet_is_used_once_while_fresh(async_client):
+    prefetched = {'existing_sheet': ('発注書_2024-05-01', False), 'existing_sheet_at': time.monotonic()}
+    assert async_client.take_existing_sheet(prefetched, '発注書_2024-05-02') is None # 別の日の発注書
+    prefetched = {'existing_sheet': ('発注書_2024-05-01', False), 'existing_sheet_at': time.monotonic()}
+    assert async_client.take_existing_sheet(prefetched, '発注書_2024-05-01') == ('発注書_2024-05-01', False)
+    assert async_client.take_existing_sheet(prefetched, '発注書_2024-05-01') is None # 2回目は確認し直す
+
+def test_stale_prefetched_existing_sheet_is_rechecked(async_client):
+    from Automation import CACHE_TTL
+    prefetched = {'existing_sheet': ('発注書_2024-05-01', False), 'existing_sheet_at': time.monotonic() - CACHE_TTL['existing_sheet'] - 1}
+    assert async_client.take_existing_sheet(prefetched, '発注書_2024-05-01') is None
+
+def test_notices_are_cached_per_day(gas_stub, gas_handler):
+    gas_stub.replies['getNotice'] = [(200, {'notices': ['5/1のお知らせ']}), (200, {'notices': ['5/2のお知らせ']})]
+    assert gas_handler.get_notices('3.7.0', datetime(2024, 5, 1, 23, 0)) == ['5/1のお知らせ']
+    assert gas_handler.get_notices('3.7.0', datetime(2024, 5, 1, 23, 30)) == ['5/1のお知らせ'] # キャッシュ
+    assert gas_handler.get_notices('3.7.0', datetime(2024, 5, 2, 6, 0)) == ['5/2のお知らせ']
+    assert gas_stub.count('getNotice') == 2
+
+def test_notices_fall_back_to_previous_day(gas_stub, gas_handler):
+    gas_stub.replies['getNotice'] = [(200, {'notices': ['5/1のお知らせ']}), (400, {})]
+    assert gas_handler.get_notices('3.7.0', datetime(2024, 5, 1, 23, 0)) == ['5/1のお知らせ']
+    assert gas_handler.get_notices('3.7.0', datetime(2024, 5, 2, 6, 0)) == ['5/1のお知らせ'] # 取得失敗
+
+def test_notices_without_cache_are_empty_on_failure(gas_stub, gas_handler):
+    gas_stub.replies['getNotice'] = [(400, {})]
+    assert gas_handler.get_notices('3.7.0', datetime(2024, 5, 2, 6, 0)) is False
+
+def test_old_notices_are_pruned(gas_stub, gas_handler):
+    gas_stub.replies['getNotice'] = [(200, {'notices': ['5/1のお知らせ']}), (200, {'notices': ['5/2のお知らせ']})]
+    gas_handler.get_notices('3.7.0', datetime(2024, 5, 1, 23, 0))
+    gas_handler.get_notices('3.7.0', datetime(2024, 5, 2, 6, 0))
+    assert [key for key in gas_handler.cache.load() if key.startswith('notices:')] == ['notices:3.7.0:2024-05-02']
+
+def test_connection_errors_are_retried_only_by_policy(gas_handler):
+    import socket
+    with socket.socket() as sock: # 接続できないポート
+        sock.bind(('127.0.0.1', 0))
+        gas_handler.script_url = f'http://127.0.0.1:{sock.getsockname()[1]}/exec'
+    attempts = []
+    gas_handler.gas_progress = lambda function_name, attempt, max_attempts: attempts.append(attempt)
+    start = time.monotonic()
+    with pytest.raises(Exception):
+        gas_handler.call_google_script('getNotice', {}, FAST_POLICY)
+    assert attempts == [1, 2, 3] and time.monotonic() - start < 2
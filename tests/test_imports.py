@@ -0,0 +1,13 @@
+# © 2024 Keita Iwasa
+# アプリの起動時に読み込むモジュールが、重いモジュールを読み込まないことのテスト
+
+import pytest
+
+from benchmark import HEAVY_MODULES, IMPORT_MODULES, import_time
+
+@pytest.mark.parametrize('module', IMPORT_MODULES)
+def test_module_does_not_import_heavy_modules(module):
+    measured = import_time(module, repeat=1)
+    assert measured is not None, f'{module}を読み込めません'
+    seconds, heavy = measured
+    assert heavy == [], f'{module}が起動時に{", ".join(heavy)}を読み込んでいます（{HEAVY_MODULES}は使うときに読み込む）'
@@ -0,0 +1,93 @@
+# © 2024 Keita Iwasa
+# order_data.pyのテスト
+
+import io
+import json
+import os
+from datetime import datetime
+
+import pandas as pd
+
+from order_data import read_eos_csv, parse_eos_date, filter_delivery_date, to_int64, normalize_food, normalize_nonfood, OrderPlan
+
+def eos_csv(*rows):
+    return io.StringIO('\n'.join(['納品予定日,納品日,発注数'] + list(rows)) + '\n')
+
+def test_parse_eos_date_empty_cell_is_nat():
+    df = read_eos_csv(eos_csv('2024-05-01(水),,1', '2024-05-02(木),2024-05-02(木),2'))
+    dates = parse_eos_date(df['納品日'])
+    assert dates.isna().tolist() == [True, False]
+    assert dates[1] == datetime(2024, 5, 2)
+
+def test_filter_delivery_date_skips_empty_date_cells():
+    # 空欄の納品日が最後の日付（2024-05-02）として扱われないこと
+    df = read_eos_csv(eos_csv('2024-05-01(水),,1', '2024-05-02(木),2024-05-02(木),2', '2024-04-30(火),,3'))
+    assert filter_delivery_date(df, datetime(2024, 5, 2))['発注数'].tolist() == [2]
+
+def test_filter_delivery_date_matches_either_column():
+    df = read_eos_csv(eos_csv('2024-05-02(木),,1', ',2024-05-02(木),2', '2024-05-03(金),2024-05-03(金),3', ',,4'))
+    assert filter_delivery_date(df, datetime(2024, 5, 2))['発注数'].tolist() == [1, 2]
+
+def food_df(*rows): # (商品名, セット, 商品コード, 発注数)
+    values = [['商品名', 'セット', '商品コード', '現在庫', '発注数']] + [[name, set_value, code, 0, order] for name, set_value, code, order in rows]
+    return normalize_food(values)[0]
+
+def table_row(code, prdx, set_value=1, limit=0):
+    return {'code': code, 'name': '', 'prdx': prdx, 'set': set_value, 'limit': limit}
+
+def test_order_plan_matches_codes_and_multiplies_sets():
+    df = food_df(('A', 6, 100001, 2), ('B', 1, 100002, 0), ('C', 12, 100003, 1))
+    plan = OrderPlan(df).compile([table_row(100003, 'prdx1', 12), table_row(100001, 'prdx0', 6)])
+    assert plan.vector() == [['prdx0', 12], ['prdx1', 12]] # 発注書の順番
+    assert plan.errors == []
+
+def test_order_plan_reports_missing_codes():
+    plan = OrderPlan(food_df(('A', 1, 100001, 1), ('B', 1, 100002, 3))).compile([table_row(100002, 'prdx0')])
+    assert plan.vector() == [['prdx0', 3]]
+    assert plan.errors == ['100001：A（エラー理由：EOSに存在しない商品, 商品番号の誤り, お気に入り未登録）']
+
+def test_order_plan_uses_first_duplicate_and_numeric_strings():
+    plan = OrderPlan(food_df(('A', 6, 100001, 1))).compile([table_row('100001', 'prdx0', '6'), table_row(100001, 'prdx9', 6)])
+    assert plan.vector() == [['prdx0', 6]]
+
+def test_order_plan_caps_at_limit():
+    # 制限数量以上は入力できないので、制限数量未満の最大のセット数の倍数にする
+    plan = OrderPlan(food_df(('A', 6, 100001, 5), ('B', 6, 100002, 1))).compile([table_row(100001, 'prdx0', 6, 20), table_row(100002, 'prdx1', 6, 20)])
+    assert plan.vector() == [['prdx0', 18], ['prdx1', 6]]
+    assert plan.entries['MAX超え'].tolist() == [True, False]
+    assert plan.errors == ['100001：A（エラー理由：発注数MAX超え）']
+
+def test_order_plan_orders_without_limit():
+    plan = OrderPlan(food_df(('A', 1, 100001, 2))).compile([table_row(100001, 'prdx0', 1, None)])
+    assert plan.orders() == [('prdx0', 100001, 1, 2, None)]
+
+def test_order_plan_set_mismatches():
+    plan = OrderPlan(food_df(('A', 6, 100001, 1), ('B', 12, 100002, 1))).compile([table_row(100001, 'prdx0', 6), table_row(100002, 'prdx1', 6)])
+    assert plan.set_mismatches == [100002]
+    assert plan.vector() == [['prdx0', 6], ['prdx1', 6]] # セット数はEOSの値を使う
+
+def test_order_plan_records_order_quantity_before_limit():
+    plan = OrderPlan(food_df(('A', 6, 100001, 5))).compile([table_row(100001, 'prdx0', 6, 20)])
+    record = plan.records()[0]
+    assert (record['発注数量'], record['入力数'], record['制限数量']) == (30, 18, 20)
+
+def load_golden():
+    # 従来のget_spreadsheetの処理の結果（tests/data/sheet_golden.json）
+    with open(os.path.join(os.path.dirname(__file__), 'data', 'sheet_golden.json'), 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+def test_normalize_matches_legacy_golden_file():
+    golden = load_golden()
+    df_food, missing_names = normalize_food(golden['values_food'])
+    assert df_food.astype(object).to_dict('records') == golden['food']
+    assert missing_names == golden['missing_names']
+    assert normalize_nonfood(golden['values_nonfood']).astype(object).to_dict('records') == golden['nonfood']
+
+def test_to_int64_truncates_toward_zero():
+    assert to_int64(pd.Series([1.5, -1.5, -2.7, 3, '4', '', None], dtype=object)).tolist() == [1, -1, -2, 3, 4, pd.NA, pd.NA]
+
+def test_normalize_food_lists_missing_stock():
+    values_food = [['商品名', 'セット', '商品コード', '現在庫', '発注数'], ['A', 6, 100001, '', 1], ['B', 6, 100002, 'なし', ''], ['C', 1, 100003, 0]]
+    df_food, missing_names = normalize_food(values_food)
+    assert missing_names == ['A', 'B']
+    assert df_food['発注数'].tolist() == [1, 0, 0] # 空欄は0
@@ -0,0 +1,26 @@
+# © 2024 Keita Iwasa
+# pipeline.py・コマンドライン実行（kaos_cli.py・batch_runner.py）の段階の指定のテスト
+
+import pytest
+
+pytest.importorskip('requests')
+
+import batch_runner
+import kaos_cli
+from Automation import AutomationHandler
+from pipeline import OrderPipeline
+
+def test_generate_requires_download():
+    pipeline = OrderPipeline(AutomationHandler({'SHOP_NAME': 'テスト店'}))
+    with pytest.raises(ValueError, match='download'):
+        pipeline.run(['generate'])
+    with pytest.raises(ValueError, match='download'):
+        pipeline.run(['generate', 'download'])
+
+@pytest.mark.parametrize('main, argv', [(kaos_cli.main, ['run', '--stage', 'download,input']),
+                                        (batch_runner.main, ['--stage', 'download,input'])])
+def test_headless_runs_reject_input(main, argv, capsys):
+    with pytest.raises(SystemExit) as exit_info:
+        main(argv)
+    assert exit_info.value.code == 2
+    assert 'input' in capsys.readouterr().err
@@ -0,0 +1,22 @@
+# © 2024 Keita Iwasa
+# tracing.pyのテスト
+
+import json
+import threading
+import time
+
+from tracing import RunTimeline
+
+def test_concurrent_saves_keep_a_valid_timeline(tmp_path):
+    path = tmp_path / 'timeline.json'
+    timeline = RunTimeline('テスト店', str(path))
+    def record(index):
+        for _ in range(20):
+            timeline.record(f'step{index}', time.monotonic())
+    threads = [threading.Thread(target=record, args=(index,)) for index in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(json.loads(path.read_text(encoding='utf-8'))['spans']) == 160
+    assert not (tmp_path / 'timeline.json.tmp').exists()
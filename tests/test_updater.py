@@ -0,0 +1,91 @@
+# © 2024 Keita Iwasa
+# AutomationHandler.download_updaterのテスト（Rangeでの再開・416・sha256の照合）
+# インストーラーの配布元の代わりにローカルのHTTPサーバーを使う
+
+import hashlib
+import os
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+pytest.importorskip('requests')
+
+from Automation import AutomationHandler
+
+INSTALLER = bytes(range(256)) * 1024 # 256KiB
+
+class UpdateRequestHandler(BaseHTTPRequestHandler):
+    # Rangeに対応した配布元。drop_afterを設定すると、最初の応答をその長さで切断する
+    drop_after = None
+    ranges = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        requested = self.headers.get('Range')
+        type(self).ranges.append(requested)
+        start = int(requested[len('bytes='):-1]) if requested else 0
+        if start >= len(INSTALLER):
+            self.send_response(416)
+            self.send_header('Content-Range', f'bytes */{len(INSTALLER)}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = INSTALLER[start:]
+        self.send_response(206 if requested else 200)
+        if requested:
+            self.send_header('Content-Range', f'bytes {start}-{len(INSTALLER) - 1}/{len(INSTALLER)}')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if type(self).drop_after:
+            self.wfile.write(body[:type(self).drop_after])
+            type(self).drop_after = None
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+@pytest.fixture
+def update_server(tmp_path, monkeypatch):
+    # 古いインストーラーの削除（setup/KAOS_setup.*.exe）はtmp_pathの中で行う
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('setup')
+    request_handler = type('BoundUpdateRequestHandler', (UpdateRequestHandler,), {'ranges': []})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), request_handler)
+    threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True).start()
+    yield request_handler, f'http://127.0.0.1:{server.server_port}/kaos/'
+    server.shutdown()
+    server.server_close()
+
+def update_handler(url, sha256=None):
+    handler = AutomationHandler({'SHOP_NAME': 'テスト店', 'UPDATE_URL': url})
+    handler.version_manifest = {'default': '3.8.0', 'sha256': {'3.8.0': sha256}} if sha256 else {'default': '3.8.0'}
+    return handler
+
+def test_resumes_interrupted_download(update_server):
+    request_handler, url = update_server
+    request_handler.drop_after = 131072 # 2チャンク
+    progress = []
+    handler = update_handler(url, hashlib.sha256(INSTALLER).hexdigest())
+    assert handler.download_updater('3.8.0', 'setup/KAOS_setup.3.8.0.exe', lambda downloaded, total: progress.append((downloaded, total)))
+    with open('setup/KAOS_setup.3.8.0.exe', 'rb') as file:
+        assert file.read() == INSTALLER
+    assert request_handler.ranges == [None, 'bytes=131072-']
+    assert progress[-1] == (len(INSTALLER), len(INSTALLER))
+
+def test_already_complete_part_file_is_used(update_server):
+    request_handler, url = update_server
+    with open('setup/KAOS_setup.3.8.0.exe.part', 'wb') as file:
+        file.write(INSTALLER)
+    handler = update_handler(url, hashlib.sha256(INSTALLER).hexdigest())
+    assert handler.download_updater('3.8.0', 'setup/KAOS_setup.3.8.0.exe')
+    assert request_handler.ranges == [f'bytes={len(INSTALLER)}-'] # 416
+    assert os.path.getsize('setup/KAOS_setup.3.8.0.exe') == len(INSTALLER)
+
+def test_sha256_mismatch_discards_download(update_server):
+    _, url = update_server
+    handler = update_handler(url, '0' * 64)
+    assert not handler.download_updater('3.8.0', 'setup/KAOS_setup.3.8.0.exe')
+    assert not os.path.exists('setup/KAOS_setup.3.8.0.exe')
+    assert not os.path.exists('setup/KAOS_setup.3.8.0.exe.part') # 壊れたファイルから再開しない
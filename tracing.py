@@ -0,0 +1,229 @@
+# © 2024 Keita Iwasa
+# 処理時間の記録（段階ごとの開始・終了時刻、通信量、WebDriverの呼び出し回数）
+# 1回の実行（アプリの起動からの終了まで・CLIの1回の実行・一括実行の1店舗）ごとにJSONのタイムラインを保存する
+#
+# 直近の実行の集計: python tracing.py summary error_log --last 30
+# WebDriverの呼び出しの多い箇所: python tracing.py hotspots error_log/<ファイル名>_timeline.json
+
+import argparse
+import functools
+import glob
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+class CommandBudgetExceeded(Exception):
+    pass
+
+class DriverProfiler:
+    # WebDriverのコマンドごとの回数・所要時間を、呼び出し元の行ごとに集計する
+    # WebElementの操作（click・send_keys・get_attributeなど）もdriver.executeを通るので、driver.executeだけを置き換える
+    def __init__(self):
+        self.total = 0
+        self.stats = {} # (コマンド名, 呼び出し元) -> [回数, 合計秒]
+        self.lock = threading.Lock()
+
+    def watch(self, driver):
+        execute = driver.execute
+        def profiled_execute(driver_command, *args, **kwargs):
+            site = self.call_site()
+            start = time.perf_counter()
+            try:
+                return execute(driver_command, *args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - start
+                with self.lock:
+                    self.total += 1
+                    stat = self.stats.setdefault((driver_command, site), [0, 0.0])
+                    stat[0] += 1
+                    stat[1] += seconds
+        driver.execute = profiled_execute
+        return driver
+
+    def call_site(self):
+        # Selenium・このファイル以外で最初に見つかった呼び出し元（ファイル名:行番号 関数名）
+        frame = sys._getframe(2)
+        while frame is not None:
+            filename = frame.f_code.co_filename
+            if 'selenium' not in filename and filename != __file__:
+                return f"{os.path.basename(filename)}:{frame.f_lineno} {frame.f_code.co_name}"
+            frame = frame.f_back
+        return 'unknown'
+
+    def top(self, n=10): # 合計時間の長い順
+        with self.lock:
+            stats = sorted(self.stats.items(), key=lambda item: -item[1][1])[:n]
+        return [{'command': command, 'site': site, 'count': count, 'seconds': round(seconds, 3)}
+                for (command, site), (count, seconds) in stats]
+
+    def summary(self, n=10):
+        lines = [f"WebDriverの呼び出し: {self.total}回"]
+        for stat in self.top(n):
+            lines.append(f"{stat['seconds']:8.2f}秒 {stat['count']:6d}回  {stat['command']}  {stat['site']}")
+        return '\n'.join(lines)
+
+    def check_budget(self, since, rows, per_row):
+        # sinceからのコマンド数が1行あたりper_row回を超えた場合はCommandBudgetExceeded
+        commands = self.total - since
+        if commands > rows * per_row:
+            raise CommandBudgetExceeded(f"WebDriverの呼び出しが多すぎます: {commands}回 / {rows}行（上限 {per_row}回/行）\n{self.summary()}")
+        return commands
+
+class RunTimeline:
+    def __init__(self, name='', path=None):
+        self.name = name # 店舗名など
+        self.path = path # 保存先（Noneの場合は保存しない）
+        self.started_at = datetime.now().isoformat(timespec='seconds')
+        self.origin = time.monotonic()
+        self.spans = []
+        self.profiler = DriverProfiler() # WebDriverの呼び出し回数・所要時間（watch_driverで数える）
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock() # 複数のスレッドから保存する場合に、一時ファイルの書き込みと置き換えを1つずつ行う
+        self.local = threading.local() # スレッドごとの実行中の段階
+
+    def stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    @contextmanager
+    def span(self, name, **attributes):
+        # with timeline.span('download_csv'): で囲んだ処理の時間を記録する
+        # 入れ子にした場合は親の段階名（parent）も記録する
+        stack = self.stack()
+        record = {'name': name, 'parent': stack[-1]['name'] if stack else None, 'thread': threading.current_thread().name,
+                  'start': round(time.monotonic() - self.origin, 3), 'end': None, 'seconds': None,
+                  'bytes': 0, 'webdriver_calls': 0, 'status': 'ok'}
+        record.update(attributes)
+        commands_at_start = self.profiler.total
+        stack.append(record)
+        try:
+            yield record
+        except BaseException as e:
+            record['status'] = type(e).__name__
+            raise
+        finally:
+            stack.pop()
+            record['end'] = round(time.monotonic() - self.origin, 3)
+            record['seconds'] = round(record['end'] - record['start'], 3)
+            record['webdriver_calls'] = self.profiler.total - commands_at_start
+            if stack: # 通信量は親の段階にも加算する
+                stack[-1]['bytes'] += record['bytes']
+            with self.lock:
+                self.spans.append(record)
+            if not stack:
+                self.save()
+
+    def record(self, name, start, **attributes):
+        # 入れ子にしない段階の記録（asyncioのように1つのスレッドで複数の処理が並行する場合）
+        # start: time.monotonic()の開始時刻
+        end = time.monotonic()
+        record = {'name': name, 'parent': None, 'thread': threading.current_thread().name,
+                  'start': round(start - self.origin, 3), 'end': round(end - self.origin, 3), 'seconds': round(end - start, 3),
+                  'bytes': 0, 'webdriver_calls': 0, 'status': 'ok'}
+        record.update(attributes)
+        with self.lock:
+            self.spans.append(record)
+        self.save()
+
+    def add_bytes(self, size):
+        # 実行中の段階に通信量（バイト）を加算
+        stack = self.stack()
+        if stack and size:
+            stack[-1]['bytes'] += size
+
+    def watch_driver(self, driver):
+        return self.profiler.watch(driver)
+
+    def to_dict(self):
+        with self.lock:
+            spans = sorted(self.spans, key=lambda span: span['start'])
+        return {'name': self.name, 'started_at': self.started_at, 'webdriver_calls': self.profiler.total,
+                'webdriver_hotspots': self.profiler.top(20), 'spans': spans}
+
+    def save(self):
+        if not self.path:
+            return
+        temp_path = f'{self.path}.tmp'
+        with self.save_lock:
+            try:
+                with open(temp_path, 'w', encoding='utf-8') as file:
+                    json.dump(self.to_dict(), file, ensure_ascii=False, indent=1)
+                os.replace(temp_path, self.path)
+            except OSError:
+                pass # 記録に失敗しても処理は続ける
+
+def traced(name=None):
+    # self.timelineを持つクラスのメソッド用のデコレーター（段階名は省略時はメソッド名）
+    def decorator(method):
+        span_name = name or method.__name__
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            timeline = getattr(self, 'timeline', None)
+            if timeline is None:
+                return method(self, *args, **kwargs)
+            with timeline.span(span_name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+def timeline_path(log_file):
+    # ログファイルと同じフォルダ・同じ名前のJSON
+    return os.path.splitext(log_file)[0] + '_timeline.json'
+
+def percentile(values, rate):
+    values = sorted(values)
+    index = (len(values) - 1) * rate
+    lower = int(index)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (index - lower)
+
+def aggregate(paths, by_store=False):
+    # 複数のタイムラインから段階ごとの所要時間のp50/p95を求める
+    durations = {}
+    for path in paths:
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                timeline = json.load(file)
+        except (OSError, ValueError):
+            continue
+        for span in timeline['spans']:
+            if span['seconds'] is None:
+                continue
+            key = (timeline['name'], span['name']) if by_store else span['name']
+            durations.setdefault(key, []).append(span['seconds'])
+    return {key: {'count': len(values), 'p50': round(percentile(values, 0.5), 3), 'p95': round(percentile(values, 0.95), 3)}
+            for key, values in durations.items()}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='保存したタイムラインを集計します。')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    summary_parser = subparsers.add_parser('summary', help='段階ごとのp50/p95を表示')
+    summary_parser.add_argument('folder', nargs='?', default='error_log', help='タイムラインのフォルダ')
+    summary_parser.add_argument('--last', type=int, default=30, help='集計する直近の実行数')
+    summary_parser.add_argument('--by-store', action='store_true', help='店舗ごとに集計')
+    hotspots_parser = subparsers.add_parser('hotspots', help='WebDriverの呼び出しの多い箇所を表示')
+    hotspots_parser.add_argument('timeline', help='タイムラインのファイル')
+    args = parser.parse_args(argv)
+
+    if args.command == 'hotspots':
+        with open(args.timeline, 'r', encoding='utf-8') as file:
+            timeline = json.load(file)
+        print(f"WebDriverの呼び出し: {timeline['webdriver_calls']}回")
+        for stat in timeline.get('webdriver_hotspots', []):
+            print(f"{stat['seconds']:8.2f}秒 {stat['count']:6d}回  {stat['command']}  {stat['site']}")
+        return 0
+    paths = sorted(glob.glob(os.path.join(args.folder, '*_timeline.json')), key=os.path.getmtime)[-args.last:]
+    summary = aggregate(paths, args.by_store)
+    print(f"{len(paths)}回の実行")
+    for key, stats in sorted(summary.items(), key=lambda item: -item[1]['p50']):
+        label = ' / '.join(key) if isinstance(key, tuple) else key
+        print(f"{label}\t{stats['count']}回\tp50 {stats['p50']:.2f}秒\tp95 {stats['p95']:.2f}秒")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())